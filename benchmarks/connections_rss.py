@@ -0,0 +1,106 @@
+"""
+Benchmark: connections per GB of RSS, threaded vs asyncio server.
+
+Starts the server in a subprocess, opens `--connections` idle TLS connections
+(optionally subscribing each one to a channel) and reports the server's RSS
+and thread count growth.
+
+Needs `server.crt`/`server.key` in the working directory (see README), and
+MongoDB if `--subscribe` is used.
+
+Usage:
+    python -m benchmarks.connections_rss --connections 2000
+    python -m benchmarks.connections_rss --connections 2000 --subscribe <CHANNEL_ID>
+"""
+import argparse
+import asyncio
+import socket
+import ssl
+import subprocess
+import sys
+import time
+
+from src.shared import Request, RequestType, protocol
+from src.shared.protocol import CERT, HOST, RequestWrapper
+
+STARTUP_TIMEOUT = 15
+
+
+def read_status(pid: int) -> dict[str, int]:
+    """
+    Returns the RSS (in KiB) and thread count of the process.
+    """
+    status = {}
+    with open(f"/proc/{pid}/status", encoding="ascii") as f:
+        for line in f:
+            key, value = line.split(":", maxsplit=1)
+            if key in ("VmRSS", "Threads"):
+                status[key] = int(value.split()[0])
+    return status
+
+
+def wait_for_port(port: int):
+    deadline = time.monotonic() + STARTUP_TIMEOUT
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("localhost", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise TimeoutError("Server did not start in time")
+
+
+async def open_connections(count: int, channel_id: int | None) -> list[asyncio.StreamWriter]:
+    context = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH, cafile=CERT)
+    writers = []
+    for i in range(count):
+        reader, writer = await asyncio.open_connection("localhost", HOST[1], ssl=context, server_hostname=HOST[0])
+        if channel_id is not None:
+            request = Request(RequestType.CHANNEL_SUBSCRIPTION,
+                              {"subtype": "subscribe", "id": channel_id, "last_message_id": 0})
+            await protocol.send_async(RequestWrapper(request, i, None, True), writer)
+            await protocol.receive_async(reader)
+        writers.append(writer)
+    return writers
+
+
+def run(mode: str, count: int, channel_id: int | None) -> tuple[int, int]:
+    args = [sys.executable, "-m", "server"] + (["--async"] if mode == "asyncio" else [])
+    server = subprocess.Popen(args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(HOST[1])
+        # Let the server settle after the probe connection
+        time.sleep(1)
+        before = read_status(server.pid)
+
+        async def connect_and_measure():
+            writers = await open_connections(count, channel_id)
+            await asyncio.sleep(1)
+            after = read_status(server.pid)
+            for writer in writers:
+                writer.close()
+            return after
+
+        after = asyncio.run(connect_and_measure())
+        return after["VmRSS"] - before["VmRSS"], after["Threads"] - before["Threads"]
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--connections", type=int, default=1000)
+    parser.add_argument("--subscribe", type=int, default=None, metavar="CHANNEL_ID")
+    parser.add_argument("--modes", nargs="+", default=["threaded", "asyncio"], choices=["threaded", "asyncio"])
+    args = parser.parse_args()
+
+    print(f"{'mode':<10}{'connections':>12}{'RSS delta (MiB)':>18}{'threads delta':>15}{'connections/GB':>16}")
+    for mode in args.modes:
+        rss_kib, threads = run(mode, args.connections, args.subscribe)
+        per_gb = args.connections / (rss_kib / 1024 ** 2) if rss_kib > 0 else float("inf")
+        print(f"{mode:<10}{args.connections:>12}{rss_kib / 1024:>18.1f}{threads:>15}{per_gb:>16.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Benchmark: per-message fan-out latency of a channel.
+
+Subscribes `--subscribers` in-memory clients to a channel publisher and
+measures the time from broadcasting a message until every subscriber has
+it in its response queue (no sockets or MongoDB involved). With `--encode`,
+every subscriber also encodes its frame, like the connection sender would.
+
+Usage:
+    python -m benchmarks.fanout_latency
+    python -m benchmarks.fanout_latency --subscribers 10 100 1000 10000 --workers 4
+    python -m benchmarks.fanout_latency --encode
+"""
+import argparse
+import os
+import statistics
+import threading
+import time
+
+
+class FakeClient():
+    """
+    Counts the responses it receives and sets `done` once it got `expected` of them.
+    """
+    counter_lock = threading.Lock()
+    received = 0
+    expected = 0
+    done = threading.Event()
+    encode = False
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def add_response(self, wrapped, droppable: bool = False):
+        if FakeClient.encode:
+            # pylint: disable=import-outside-toplevel
+            from src.shared import protocol
+            protocol.encode(wrapped, protocol.PROTOCOL_VERSION)
+        with FakeClient.counter_lock:
+            FakeClient.received += 1
+            if FakeClient.received == FakeClient.expected:
+                FakeClient.done.set()
+        return True
+
+
+def run(subscriber_count: int, message_count: int) -> list[float]:
+    # pylint: disable=import-outside-toplevel
+    from src.server.channel_subscription import ChannelSubscription
+    from src.server.message_publisher import MessagePublisher
+    from src.shared import Channel, ChannelType, Message, User, snowflake
+
+    channel = Channel(1, "benchmark", ChannelType.TEXT, 1)
+    publisher = MessagePublisher(channel)
+    subscriptions = []
+    for i in range(subscriber_count):
+        sub = ChannelSubscription(FakeClient(f"client{i}"), i + 1, channel)  # type: ignore
+        publisher.add_subscription(sub)
+        sub.begin(publisher)
+        subscriptions.append(sub)
+
+    author = User(1, "benchmark", "#ff0000")
+    generator = snowflake.SnowflakeGenerator(0)
+    latencies = []
+    for i in range(message_count):
+        message_id = generator.next_id()
+        message = Message(message_id, channel.id, f"message {i}", None, author, snowflake.timestamp(message_id),
+                          i + 1)
+
+        FakeClient.received = 0
+        FakeClient.expected = subscriber_count
+        FakeClient.done.clear()
+        start = time.perf_counter()
+        publisher.broadcast(message, None)  # type: ignore
+        FakeClient.done.wait()
+        latencies.append(time.perf_counter() - start)
+
+    for sub in subscriptions:
+        sub.stop()
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subscribers", type=int, nargs="+", default=[10, 100, 1000, 10000])
+    parser.add_argument("--messages", type=int, default=50)
+    parser.add_argument("--workers", type=int, default=0, help="Fan-out workers (0 = inline)")
+    parser.add_argument("--encode", action="store_true", help="Encode every subscriber's frame")
+    args = parser.parse_args()
+    FakeClient.encode = args.encode
+
+    os.environ["LYTECORD_FANOUT_WORKERS"] = str(args.workers)
+    # pylint: disable=import-outside-toplevel
+    from loguru import logger
+    logger.remove()
+
+    print(f"Fan-out workers: {args.workers or 'inline'}")
+    print(f"{'subscribers':>12} {'median (ms)':>12} {'p99 (ms)':>10} {'per sub (us)':>13}")
+    for subscriber_count in args.subscribers:
+        latencies = run(subscriber_count, args.messages)
+        median = statistics.median(latencies)
+        p99 = sorted(latencies)[int(len(latencies) * 0.99) - 1 if len(latencies) >= 100 else -1]
+        print(f"{subscriber_count:>12} {median * 1000:>12.3f} {p99 * 1000:>10.3f} "
+              f"{median / subscriber_count * 1e6:>13.2f}")
+
+
+if __name__ == "__main__":
+    main()
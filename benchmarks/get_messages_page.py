@@ -0,0 +1,113 @@
+"""
+Benchmark: latency of a GET_MESSAGES page, hydrating each message with its own
+queries (the previous behaviour) vs. db.get_messages (batched hydration).
+
+Seeds a separate database (MONGO_DB, "LytecordBenchmark" by default) which is
+dropped at the end. Needs a running MongoDB.
+
+Usage:
+    python -m benchmarks.get_messages_page --messages 5000 --users 50 --page-size 100
+"""
+import argparse
+import os
+import statistics
+import time
+from hashlib import md5
+
+os.environ.setdefault("MONGO_DB", "LytecordBenchmark")
+
+# pylint: disable=wrong-import-position
+from src.server import asset_generator, db
+from src.shared import Attachment, AttachmentType, Message, User, snowflake
+
+CHANNEL_ID = 1
+ATTACHMENT_EVERY = 5
+
+
+def seed(message_count: int, user_count: int):
+    user_ids = [asset_generator.get_id() for _ in range(user_count)]
+    db.users.insert_many([{"_id": user_id, "username": f"user{i}", "name_color": "#ff0000"}
+                          for i, user_id in enumerate(user_ids)])
+    db.channels.insert_one({"_id": CHANNEL_ID, "name": "benchmark", "type": "text", "guild_id": 1})
+
+    docs = []
+    for i in range(message_count):
+        attachment_id = None
+        if i % ATTACHMENT_EVERY == 0:
+            data = f"attachment {i}".encode()
+            attachment_id = asset_generator.get_id()
+            db.attachments.put(data, _id=attachment_id, filename=f"file{i}.txt", attachment_type="other", width=0,
+                               height=0, hash=md5(data).hexdigest())
+        message_id = asset_generator.get_id()
+        docs.append({"_id": message_id, "channel_id": CHANNEL_ID, "content": f"message {i}",
+                     "timestamp": snowflake.timestamp(message_id), "author_id": user_ids[i % user_count],
+                     "attachment_id": attachment_id})
+    db.messages.insert_many(docs)
+
+
+def get_messages_per_message(channel_id: int, from_id: int, count: int) -> list[Message]:
+    """
+    The previous implementation: one users query and two GridFS queries per message.
+    """
+    query = {"channel_id": channel_id} if from_id == 0 else {"channel_id": channel_id, "_id": {"$lt": from_id}}
+    result = []
+    for m in db.messages.find(query).limit(count).sort("_id", -1):
+        author = db.users.find_one({"_id": m.pop("author_id")})
+        m["author"] = User.from_db_dict(author)
+        attachment_id = m.pop("attachment_id")
+        m["attachment"] = None
+        if attachment_id is not None and db.attachments.exists(attachment_id):
+            f = db.attachments.get(attachment_id)
+            m["attachment"] = Attachment(attachment_id, f.filename, AttachmentType(f.attachment_type), f.width,
+                                         f.height, f.length)
+        result.append(Message.from_db_dict(m))
+    return result
+
+
+def measure(get_page, page_size: int) -> list[float]:
+    """
+    Walk the whole channel page by page, returning the latency of each page (ms).
+    """
+    latencies = []
+    before = 0
+    while True:
+        start = time.perf_counter()
+        page = get_page(CHANNEL_ID, before, page_size)
+        latencies.append((time.perf_counter() - start) * 1000)
+        if len(page) < page_size:
+            return latencies
+        before = page[-1].id
+
+
+def report(name: str, latencies: list[float]):
+    p95 = statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else latencies[0]
+    print(f"{name:<16}{len(latencies):>8}{statistics.mean(latencies):>12.2f}{statistics.median(latencies):>12.2f}"
+          f"{p95:>12.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--page-size", type=int, default=100)
+    args = parser.parse_args()
+
+    if db.DB_NAME == "Lytecord":
+        raise SystemExit("Refusing to seed (and drop) the main database, set MONGO_DB to a different name")
+
+    db.db_client.drop_database(db.DB_NAME)
+    try:
+        db.create_indexes()
+        seed(args.messages, args.users)
+        # Warm up the connection pool
+        db.get_messages(CHANNEL_ID, 0, args.page_size)
+
+        print(f"{'':<16}{'pages':>8}{'mean (ms)':>12}{'p50 (ms)':>12}{'p95 (ms)':>12}")
+        report("per message", measure(get_messages_per_message, args.page_size))
+        report("batched", measure(db.get_messages, args.page_size))
+    finally:
+        db.db_client.drop_database(db.DB_NAME)
+
+
+if __name__ == "__main__":
+    main()
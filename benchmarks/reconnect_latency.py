@@ -0,0 +1,67 @@
+"""
+Benchmark: reconnect latency, full TLS handshake vs resumed TLS session.
+
+Connects to a running server `--reconnects` times, measuring the time from opening
+the TCP connection to finishing the protocol handshake (the point where requests can
+be sent). Each round is measured twice: once with a fresh TLS session and once
+resuming the session of the previous connection, like the client does when reconnecting.
+
+Needs a running server (`python -m server`) and `server.crt` in the working directory.
+
+Usage:
+    python -m benchmarks.reconnect_latency --reconnects 200
+"""
+import argparse
+import socket
+import ssl
+import statistics
+import time
+
+from src.shared import protocol
+from src.shared.protocol import CERT, HOST
+
+
+def connect(context: ssl.SSLContext, session: ssl.SSLSession | None) -> tuple[float, ssl.SSLSocket]:
+    """
+    Returns the time it took to connect (ms), and the connected socket.
+    """
+    start = time.perf_counter()
+    sock = context.wrap_socket(socket.create_connection(HOST), server_hostname=HOST[0], session=session)
+    protocol.client_handshake(sock)
+    return (time.perf_counter() - start) * 1000, sock
+
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--reconnects", type=int, default=100)
+    args = parser.parse_args()
+
+    context = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH, cafile=CERT)
+    results: dict[str, list[float]] = {"full": [], "resumed": []}
+    reused = 0
+    session = None
+    for _ in range(args.reconnects):
+        elapsed, sock = connect(context, None)
+        results["full"].append(elapsed)
+        # TLS 1.3 tickets arrive after the handshake, read along with the first reply
+        session = sock.session
+        sock.close()
+
+        elapsed, sock = connect(context, session)
+        results["resumed"].append(elapsed)
+        reused += sock.session_reused
+        sock.close()
+
+    print(f"{'handshake':<10}{'median (ms)':>13}{'p99 (ms)':>10}{'max (ms)':>10}")
+    for name, values in results.items():
+        print(f"{name:<10}{statistics.median(values):>13.2f}{percentile(values, 0.99):>10.2f}{max(values):>10.2f}")
+    print(f"TLS sessions reused: {reused}/{args.reconnects}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Benchmark: reconnect storm, logging in with a password vs a session token.
+
+Opens `--clients` TLS connections at once (like every client reconnecting after a
+server restart), and each one authenticates, either with the password (a bcrypt check
+on the server) or with a session token (an HMAC check). Reports the time until every
+client was authenticated, and the per-client latency. Logins rejected because the
+password pool was full ("Server busy") are reported separately, and left out of the latencies.
+
+Needs a running server (`python -m server`), `server.crt` in the working directory and
+an existing user. Set LYTECORD_SESSION_SECRET on the server if it was restarted since
+the token was issued. Every client connects from the same address, so start the server
+with LYTECORD_MAX_PASSWORD_CHECKS_PER_IP (and LYTECORD_MAX_QUEUED_PASSWORD_CHECKS) at least
+`--clients`, otherwise most password logins are rejected right away instead of measured.
+
+Usage:
+    python -m benchmarks.reconnect_storm --username <USERNAME> --password <PASSWORD> --clients 1000
+"""
+import argparse
+import asyncio
+import ssl
+import statistics
+import time
+
+from src.shared import Request, RequestType, protocol
+from src.shared.protocol import CERT, HOST, RequestWrapper
+
+
+async def authenticate(context: ssl.SSLContext, data: dict) -> tuple[float, dict]:
+    """
+    Connect and authenticate, returns the latency (ms) and the response data.
+    """
+    start = time.perf_counter()
+    reader, writer = await asyncio.open_connection(HOST[0], HOST[1], ssl=context, server_hostname=HOST[0])
+    try:
+        await protocol.send_async(RequestWrapper(Request(RequestType.AUTHENTICATE, data), 0, None), writer)
+        response, _, _ = await protocol.receive_async(reader)
+    finally:
+        writer.close()
+    return (time.perf_counter() - start) * 1000, response.data
+
+
+async def storm(context: ssl.SSLContext, clients: int, data: dict) -> tuple[float, list[float], int, int]:
+    """
+    Returns the total time (s), the latencies (ms), the number of logins rejected
+    because the server was busy, and the number of other failed logins.
+    """
+    start = time.perf_counter()
+    results = await asyncio.gather(*(authenticate(context, data) for _ in range(clients)), return_exceptions=True)
+    total = time.perf_counter() - start
+
+    responses = [r for r in results if not isinstance(r, BaseException)]
+    latencies = [latency for latency, response in responses if response["status"] == "success"]
+    busy = sum(1 for _, response in responses if response["message"].startswith("Server busy"))
+    return total, latencies, busy, clients - len(latencies) - busy
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--username", required=True)
+    parser.add_argument("--password", required=True)
+    parser.add_argument("--clients", type=int, default=1000)
+    args = parser.parse_args()
+
+    context = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH, cafile=CERT)
+    login = {"subtype": "login", "username": args.username, "password": args.password}
+    _, response = asyncio.run(authenticate(context, login))
+    if response["status"] != "success":
+        raise SystemExit(f"Login failed: {response['message']}")
+
+    modes = {"password": login, "token": {"subtype": "token", "token": response["token"]}}
+    print(f"{'login':<10}{'clients':>9}{'total (s)':>11}{'median (ms)':>13}{'p99 (ms)':>10}{'busy':>7}{'failed':>8}")
+    for name, data in modes.items():
+        total, latencies, busy, failed = asyncio.run(storm(context, args.clients, data))
+        latencies.sort()
+        median = statistics.median(latencies) if latencies else 0.0
+        p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] if latencies else 0.0
+        print(f"{name:<10}{args.clients:>9}{total:>11.2f}{median:>13.1f}{p99:>10.1f}{busy:>7}{failed:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,5 @@
+import asyncio
+import os
 import socket
 import ssl
 import sys
@@ -7,11 +9,20 @@ import time
 
 from loguru import logger
 
+from src.server import handshake_pool, password_pool
+from src.server.async_client import DB_WORKERS, AsyncClient
 from src.server.client import Client
 # pylint: disable=unused-import
 from src.shared import loguru_config
 from src.shared.protocol import HOST
 
+# Run the opt-in asyncio server instead of a thread per client
+ASYNC_MODE = "--async" in sys.argv
+# Maximum number of connections waiting to be accepted
+LISTEN_BACKLOG = int(os.getenv("LYTECORD_LISTEN_BACKLOG", "128"))
+# TLS 1.3 session tickets sent to each client, so reconnects can resume the session (0 disables resumption)
+TLS_SESSION_TICKETS = int(os.getenv("LYTECORD_TLS_SESSION_TICKETS", "2"))
+
 
 def signal_handler(_sig, _frame):
     logger.info("Shutting down server...")
@@ -23,30 +34,60 @@ def client_acceptor(bindsocket: socket.socket, context: ssl.SSLContext):
         try:
             sock, addr = bindsocket.accept()
             logger.debug(f"Connection from {addr}")
-            client_sock = context.wrap_socket(sock, server_side=True)
-            client = Client(client_sock)
-            logger.info(f"Client connected: {addr}")
-            # Run client handler in a separate thread
-            t = threading.Thread(target=client.main_handler, daemon=True)
-            t.name = f"Client handler thread; port: {client_sock.getpeername()[1]}"
-            t.start()
+            # The TLS handshake is done by the handshake pool, so a slow client can't block new connections
+            handshake_pool.submit(sock, context, start_client)
         except Exception as e:
             logger.exception(f"Error accepting client: {e}")
 
 
+def start_client(client_sock: ssl.SSLSocket):
+    client = Client(client_sock)
+    logger.info(f"Client connected: {client.name}")
+    # Run client handler in a separate thread
+    t = threading.Thread(target=client.main_handler, daemon=True)
+    t.name = f"Client handler thread; port: {client.name[1]}"
+    t.start()
+
+
+async def handle_async_client(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    handshake_pool.record_accept()
+    client = AsyncClient(reader, writer)
+    logger.info(f"Client connected: {client.name}")
+    await client.main_handler()
+
+
+async def async_main(context: ssl.SSLContext):
+    server = await asyncio.start_server(handle_async_client, "0.0.0.0", HOST[1], ssl=context,
+                                        backlog=LISTEN_BACKLOG, ssl_handshake_timeout=handshake_pool.HANDSHAKE_TIMEOUT)
+    logger.info("Server started (asyncio mode)")
+    async with server:
+        await server.serve_forever()
+
+
 def main():
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
 
     context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
     context.load_cert_chain(certfile="server.crt", keyfile="server.key")
-    bindsocket = socket.socket()
-    bindsocket.bind(("0.0.0.0", HOST[1]))
-    bindsocket.listen(5)
+    # The same context is used for every connection, so its session cache and ticket keys are shared
+    context.num_tickets = TLS_SESSION_TICKETS
 
     # Importing the db module starts the connection to the database
-    # pylint: disable=unused-import
     from src.server import db
+    db.check_indexes()
+    # user_join_guild relies on the unique memberships index, which is new to upgraded databases
+    db.create_indexes(collections=["memberships"])
+
+    if ASYNC_MODE:
+        # Password checks block a request worker while they wait, keep half of the workers for other requests
+        password_pool.limit(DB_WORKERS // 2)
+        asyncio.run(async_main(context))
+        return
+
+    bindsocket = socket.socket()
+    bindsocket.bind(("0.0.0.0", HOST[1]))
+    bindsocket.listen(LISTEN_BACKLOG)
     logger.info("Server started")
 
     threading.Thread(target=client_acceptor, args=(bindsocket, context), daemon=True).start()
@@ -4,5 +4,21 @@ def delete_db():
     for collection in db.db.list_collection_names():
         db.db.drop_collection(collection)
         
-def create_indexes():
-    db.create_indexes()
\ No newline at end of file
+def create_indexes(drop_extra: bool = False):
+    db.create_indexes(drop_extra)
+
+
+def check_indexes():
+    db.check_indexes()
+
+
+def explain_queries():
+    db.explain_queries()
+
+
+def backfill_message_seqs():
+    db.backfill_message_seqs()
+
+
+def migrate_memberships():
+    db.migrate_memberships()
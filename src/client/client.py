@@ -1,7 +1,6 @@
-import base64
 import socket
 import ssl
-import zlib
+import threading
 from dataclasses import dataclass
 from enum import Enum
 from functools import wraps
@@ -13,10 +12,16 @@ from loguru import logger
 from src.client.request_manager import RequestManager
 from src.shared import (Channel, ChannelType, Guild, Message, Request,
                         RequestType, login_utils)
-from src.shared.attachment import Attachment
-from src.shared.protocol import CERT, HOST
+from src.shared.attachment import CHUNK_SIZE, Attachment
+from src.shared.protocol import CERT, HOST, ProtocolException, SocketClosedException
 from src.shared.user import User
 
+# Reconnect attempts after the connection is lost (each waits twice as long as the previous one)
+RECONNECT_ATTEMPTS = 5
+RECONNECT_DELAY = 0.5
+# Seconds to wait for the connection (and the TLS and protocol handshakes) to the server
+CONNECT_TIMEOUT = 5
+
 
 def ensure_correct_data(default: tuple, callback: Callable):
     def outer(func: Callable[[Request], None]):
@@ -38,6 +43,19 @@ class Subscription:
     channel: Channel | None
     id: int | None
     last_message_id: int = 0
+    # Sequence number of the newest message received in the channel (used to resume)
+    last_seq: int = 0
+    # Called with every new message (kept to subscribe again after reconnecting)
+    callback: Callable[[Message | None], None] | None = None
+
+
+@dataclass(eq=False)
+class PendingUpload:
+    attachment: Attachment
+    blob: bytes
+    callback: Callable[[Attachment | None, str], None]
+    # Set by the server once the upload begins
+    upload_id: int | None = None
 
 
 class AuthType(Enum):
@@ -58,16 +76,86 @@ class Client():
     def __init__(self, ip: str, port: int, app: CTk):
         self.ip = ip
         self.port = port
+        self.app = app
         self.context = ssl.create_default_context(purpose=ssl.Purpose.SERVER_AUTH, cafile=CERT)
-        self.sock: ssl.SSLSocket = self.context.wrap_socket(socket.socket(socket.AF_INET, socket.SOCK_STREAM), server_hostname=HOST[0])
-        self.sock.connect((self.ip, self.port))
-        self.sock.setblocking(True)
-        
+        # The TLS session of the last connection, resumed when reconnecting (skips the full handshake)
+        self.tls_session: ssl.SSLSession | None = None
+        self.reconnect_attempts = 0
+
         self.user: User | None = None
+        # Logs in again after reconnecting, without the password
+        self.session_token: str | None = None
         self.subscription: Subscription = Subscription(None, None)
-        self.request_manager: RequestManager = RequestManager(self.sock, app)
+        self.pending_uploads: list[PendingUpload] = []
+        self._connect()
+
+    def _connect(self):
+        self.sock: ssl.SSLSocket = self.context.wrap_socket(socket.socket(socket.AF_INET, socket.SOCK_STREAM),
+                                                            server_hostname=HOST[0], session=self.tls_session)
+        # The request manager makes the socket blocking again after the protocol handshake
+        self.sock.settimeout(CONNECT_TIMEOUT)
+        self.sock.connect((self.ip, self.port))
+        if self.sock.session_reused:
+            logger.debug("Resumed TLS session")
+
+        self.request_manager: RequestManager = RequestManager(self.sock, self.app, on_disconnect=self._on_disconnect)
         self.request_manager.begin()
 
+    def _on_disconnect(self):
+        if self.reconnect_attempts >= RECONNECT_ATTEMPTS:
+            logger.error("Failed to reconnect to the server")
+            return
+
+        delay = RECONNECT_DELAY * 2 ** self.reconnect_attempts
+        self.reconnect_attempts += 1
+        logger.warning(f"Disconnected from the server, reconnecting in {delay:.1f}s")
+        self.app.after(int(delay * 1000), self._try_reconnect)
+
+    def _try_reconnect(self):
+        # Connecting blocks, so it isn't done in the app's thread
+        threading.Thread(target=self._reconnect_thread, daemon=True, name="Reconnect thread").start()
+
+    def _reconnect_thread(self):
+        try:
+            self._reopen()
+        except (OSError, ProtocolException, SocketClosedException) as e:
+            logger.warning(f"Reconnect failed: {e}")
+            self.app.after_idle(self._on_disconnect)
+            return
+        self.app.after_idle(self._restore_session)
+
+    def reconnect(self):
+        """
+        Open a new connection to the server (resuming the TLS session of the previous one),
+        and restore the channel subscription and pending uploads.
+        Blocks until connected (at most CONNECT_TIMEOUT seconds).
+        """
+        self._reopen()
+        self._restore_session()
+
+    def _reopen(self):
+        if self.sock.session is not None:
+            self.tls_session = self.sock.session
+        # Closing the socket first unblocks the receiver thread
+        self.sock.close()
+        # Requests waiting for a response are answered with an error
+        self.request_manager.stop()
+
+        self._connect()
+        self.reconnect_attempts = 0
+        logger.success("Reconnected to the server")
+
+    def _restore_session(self):
+        if self.session_token is not None:
+            self.authenticate_token()
+
+        channel, callback = self.subscription.channel, self.subscription.callback
+        self.subscription.id = None
+        if channel is not None and callback is not None:
+            # last_seq is kept, so the server sends the messages missed while disconnected
+            self.subscribe_channel(channel, callback)
+        self.resume_uploads()
+
     def authenticate(self, subtype: AuthType, username: str, password: str, color: str,
                      callback: Callable[[bool, str], None]):
         @ensure_correct_data(default=(False,), callback=callback)
@@ -76,6 +164,7 @@ class Client():
             status = req.data["status"] == "success"
             if status and msg == "Authenticated" or msg == "Registered":
                 self.user = User.from_json_serializeable(req.data["user"])
+                self.session_token = req.data.get("token")
                 logger.info(f"logged in with user: {self.user}")
                 callback(True, 'Authenticated')
             callback(False, msg)
@@ -86,6 +175,39 @@ class Client():
         request = Request(RequestType.AUTHENTICATE, d)
         self.request_manager.request(request, callback=c)
 
+    def authenticate_token(self, callback: Callable[[bool, str], None] | None = None):
+        """
+        Log in again with the session token received when logging in (e.g. after reconnecting).
+        """
+        def c(req: Request):
+            status = req.data.get("status") == "success"
+            if not status:
+                logger.warning(f"Session token rejected: {req.data.get('message')}")
+                self.session_token = None
+                self.user = None
+            if callback:
+                callback(status, req.data.get("message", ""))
+
+        request = Request(RequestType.AUTHENTICATE, {"subtype": "token", "token": self.session_token})
+        self.request_manager.request(request, callback=c)
+
+    def logout(self, callback: Callable[[bool, str], None] | None = None):
+        """
+        Log out, revoking every session token of the user.
+        """
+        def c(req: Request):
+            status = req.data.get("status") == "success"
+            if status:
+                self.user = None
+                self.session_token = None
+            if callback:
+                callback(status, req.data.get("message", ""))
+
+        # The server drops the subscription on logout, so it isn't restored after reconnecting either
+        if self.subscription.channel is not None and self.subscription.id is not None:
+            self.unsubscribe_channel()
+        self.request_manager.request(Request(RequestType.AUTHENTICATE, {"subtype": "logout"}), callback=c)
+
     def get_guilds(self, callback: Callable[[list[Guild]], None]):
         @ensure_correct_data(default=([],), callback=callback)
         def c(req: Request):
@@ -117,6 +239,7 @@ class Client():
                 messages = [Message.from_json_serializeable(message) for message in req.data["messages"]]
                 if len(messages) > 0:
                     self.subscription.last_message_id = messages[0].id
+                    self.subscription.last_seq = max(self.subscription.last_seq, messages[0].seq)
                 callback(messages)
             else:
                 callback([])
@@ -134,12 +257,18 @@ class Client():
 
         c_id = channel.id
         confirmation = {"status": False}
+        self.subscription.callback = callback
 
         # Callback for the subscription request
         @ensure_correct_data(default=(None,), callback=callback)
         def c(req: Request):
             if confirmation["status"]:
+                if req.data.get("status") == "resync":
+                    # The server dropped messages because we fell behind
+                    self._resync_channel()
+                    return
                 message = Message.from_json_serializeable(req.data["message"])
+                self.subscription.last_seq = max(self.subscription.last_seq, message.seq)
                 callback(message)
                 return
 
@@ -150,9 +279,25 @@ class Client():
                 self.subscription.id = None
 
         request = Request(RequestType.CHANNEL_SUBSCRIPTION,
-                          {"subtype": "subscribe", "id": c_id, "last_message_id": self.subscription.last_message_id})
+                          {"subtype": "subscribe", "id": c_id, "last_message_id": self.subscription.last_message_id,
+                           "last_seq": self.subscription.last_seq})
         self.subscription.id = self.request_manager.subscribe(request, callback=c)
 
+    def _resync_channel(self):
+        """
+        Subscribe to the current channel again, from the last message received
+        (the server sends the missed messages).
+        """
+        channel, callback = self.subscription.channel, self.subscription.callback
+        if channel is None or callback is None or self.subscription.id is None:
+            return
+
+        logger.warning(f"Resyncing channel {channel.name}")
+        self.request_manager.unsubscribe(self.subscription.id,
+                                         Request(RequestType.CHANNEL_SUBSCRIPTION, {"subtype": "unsubscribe"}))
+        self.subscription.id = None
+        self.subscribe_channel(channel, callback)
+
     def unsubscribe_channel(self):
         if self.subscription.channel is None or self.subscription.id is None:
             logger.warning("Not subscribed to any channel")
@@ -162,6 +307,8 @@ class Client():
         self.subscription.channel = None
         self.subscription.id = None
         self.subscription.last_message_id = 0
+        self.subscription.last_seq = 0
+        self.subscription.callback = None
         self.request_manager.unsubscribe(id, Request(RequestType.CHANNEL_SUBSCRIPTION, {"subtype": "unsubscribe"}))
 
     def send_message(self, message: Message, callback: Callable[[Message | None], None]):
@@ -173,6 +320,9 @@ class Client():
         def c(req: Request):
             if req.data["status"] == "success":
                 message = Message.from_json_serializeable(req.data["message"])
+                # The server doesn't push our own messages, so they don't advance last_seq otherwise
+                if self.subscription.channel is not None and message.channel_id == self.subscription.channel.id:
+                    self.subscription.last_seq = max(self.subscription.last_seq, message.seq)
                 callback(message)
             else:
                 callback(None)
@@ -242,35 +392,101 @@ class Client():
         self.request_manager.request(request, callback=c)
 
     def get_attachment_file(self, attachment_id: int, callback: Callable[[bytes | None, str], None]):
+        """
+        Download an attachment file, one chunk (range) at a time.
+        """
+        file = bytearray()
+
         @ensure_correct_data(default=(None, 'Unexpected client error'), callback=callback)
         def c(req: Request):
-            if req.data["status"] == "success":
-                b64_file: str = req.data["file"]
-                compressed = base64.b64decode(b64_file)
-                file = zlib.decompress(compressed)
-                callback(file, '')
-            else:
+            if req.data["status"] != "success" or req.blob is None:
                 message: str = req.data["message"]
                 callback(None, message)
+                return
 
-        request = Request(RequestType.GET_ATTACHMENT_FILE, {"attachment_id": attachment_id})
-        self.request_manager.request(request, callback=c)
+            file.extend(req.blob)
+            if len(file) >= req.data["size"] or len(req.blob) == 0:
+                callback(bytes(file), '')
+            else:
+                request_range()
+
+        def request_range():
+            request = Request(RequestType.GET_ATTACHMENT_RANGE,
+                              {"attachment_id": attachment_id, "offset": len(file), "length": CHUNK_SIZE})
+            self.request_manager.request(request, callback=c)
+
+        request_range()
 
     def upload_attachment(self, attachment: Attachment, blob: bytes,
                           callback: Callable[[Attachment | None, str], None]):
-        @ensure_correct_data(default=(None, None, 'Unexpected client error'), callback=callback)
+        """
+        Upload an attachment file in chunks.
+        
+        Until the upload is committed it is kept in pending_uploads,
+        so it can be continued with resume_uploads (e.g. after reconnecting).
+        """
+        upload = PendingUpload(attachment, blob, callback)
+        self.pending_uploads.append(upload)
+        self._begin_upload(upload)
+
+    def resume_uploads(self):
+        """
+        Continue all pending uploads from the offset the server has.
+        """
+        for upload in self.pending_uploads:
+            self._begin_upload(upload)
+
+    def _fail_upload(self, upload: PendingUpload, message: str):
+        if upload in self.pending_uploads:
+            self.pending_uploads.remove(upload)
+        upload.callback(None, message)
+
+    def _begin_upload(self, upload: PendingUpload):
+        @ensure_correct_data(default=(upload, 'Unexpected client error'), callback=self._fail_upload)
         def c(req: Request):
             if req.data["status"] == "success":
-                attachment = Attachment.from_json_serializeable(req.data["attachment"])
-                callback(attachment, '')
+                upload.upload_id = req.data["upload_id"]
+                self._send_upload_chunk(upload, req.data["offset"])
             else:
-                message: str = req.data["message"]
-                callback(None, message)
+                self._fail_upload(upload, req.data["message"])
+
+        request = Request(RequestType.UPLOAD_ATTACHMENT_CHUNKED,
+                          {"subtype": "begin", "filename": upload.attachment.filename,
+                           "type": upload.attachment.a_type.value, "size": len(upload.blob),
+                           "upload_id": upload.upload_id})
+        self.request_manager.request(request, callback=c)
+
+    def _send_upload_chunk(self, upload: PendingUpload, offset: int):
+        if offset >= len(upload.blob):
+            self._commit_upload(upload)
+            return
+
+        @ensure_correct_data(default=(upload, 'Unexpected client error'), callback=self._fail_upload)
+        def c(req: Request):
+            # On an unexpected offset, the server tells where to continue from
+            # (a chunk it refused leaves the offset where it was)
+            if req.data.get("offset", offset) != offset:
+                self._send_upload_chunk(upload, req.data["offset"])
+            else:
+                self._fail_upload(upload, req.data["message"])
+
+        request = Request(RequestType.UPLOAD_ATTACHMENT_CHUNKED,
+                          {"subtype": "chunk", "upload_id": upload.upload_id, "offset": offset},
+                          upload.blob[offset:offset + CHUNK_SIZE])
+        self.request_manager.request(request, callback=c)
+
+    def _commit_upload(self, upload: PendingUpload):
+        @ensure_correct_data(default=(upload, 'Unexpected client error'), callback=self._fail_upload)
+        def c(req: Request):
+            if req.data["status"] != "success":
+                self._fail_upload(upload, req.data["message"])
+                return
+
+            attachment = Attachment.from_json_serializeable(req.data["attachment"])
+            self.pending_uploads.remove(upload)
+            upload.callback(attachment, '')
 
-        compressed = zlib.compress(blob)
-        b64_blob = base64.b64encode(compressed).decode()
-        request = Request(RequestType.UPLOAD_ATTACHMENT,
-                          {"filename": attachment.filename, "type": attachment.a_type.value, "file": b64_blob})
+        request = Request(RequestType.UPLOAD_ATTACHMENT_CHUNKED, {"subtype": "commit", "upload_id": upload.upload_id})
         self.request_manager.request(request, callback=c)
 
     def close(self):
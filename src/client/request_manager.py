@@ -19,10 +19,16 @@ MAX_ID = 2 ** 10
 
 
 class RequestManager():
-    def __init__(self, sock: socket.socket, app: CTk):
+    def __init__(self, sock: socket.socket, app: CTk, on_disconnect: Callable[[], None] | None = None):
         self._sock = sock
         self._app = app
+        # Called (in the app's thread) if the connection is lost while running
+        self._on_disconnect = on_disconnect
         self._continue = False
+        # Set once stopped (new requests fail right away)
+        self._stopped = False
+        # Negotiated with the server in begin()
+        self._protocol_version = 1
         # outgoing
         self._requests: Queue[RequestWrapper] = Queue()
         self._current_id = 0
@@ -45,6 +51,10 @@ class RequestManager():
         Start the request manager. This will start the sender and receiver threads.
         """
         if not self._continue:
+            self._protocol_version = protocol.client_handshake(self._sock)
+            # The socket may have a timeout for connecting, but responses are waited for indefinitely
+            self._sock.settimeout(None)
+            logger.info(f"Using protocol version {self._protocol_version}")
             self._continue = True
             self._sender.start()
             self._receiver.start()
@@ -52,6 +62,9 @@ class RequestManager():
     def stop(self):
         """
         Stop the request manager. This will stop the sender and receiver threads.
+
+        The callbacks of requests that didn't get a response (and of requests made
+        after stopping) are called with an error response.
         """
         if self._continue:
             self._continue = False
@@ -59,6 +72,27 @@ class RequestManager():
                 self._sender_condition.notify()
             self._sender.join()
             self._receiver.join()
+        self._stopped = True
+        self._fail_pending()
+
+    def _fail_pending(self):
+        with self._send_lock:
+            with self._normal_lock:
+                pending = list(self._normal_requests.values())
+                self._normal_requests.clear()
+            while not self._requests.empty():
+                wrapped = self._requests.get()
+                # Subscriptions are restored by the client after reconnecting
+                if not wrapped.subscribed:
+                    pending.append(wrapped)
+
+        for wrapped in pending:
+            self._fail(wrapped)
+
+    def _fail(self, wrapped: RequestWrapper):
+        if wrapped.callback:
+            response = Request(RequestType.ERROR, {"status": "error", "message": "Disconnected from the server"})
+            self._app.after_idle(wrapped.callback, response)
 
     def _run_sender(self):
         with self._sender_condition:
@@ -81,14 +115,14 @@ class RequestManager():
                         self._normal_requests[request_id] = req
                 
                 # send the request
-                protocol.send(req, self._sock)
+                protocol.send(req, self._sock, self._protocol_version)
 
     def _run_receiver(self):
         while self._continue:
             try:
                 # block until a response is received
                 # the request_id is used to find the request that corresponds to the response
-                req, request_id, subbed = protocol.receive(self._sock)
+                req, request_id, subbed = protocol.receive(self._sock, self._protocol_version)
                 error = req.request_type == RequestType.ERROR
                 if error:
                     logger.warning(f"Received error from server: {req.data['message']}")
@@ -121,13 +155,21 @@ class RequestManager():
 
                         if wrapped.callback:
                             self._app.after_idle(wrapped.callback, req)
-            except SocketClosedException:
+            except (SocketClosedException, OSError):
                 logger.warning("Socket closed")
                 break
             except Exception as e:
                 logger.exception(f"Caught exception in receiver: {e}")
                 break
 
+        if self._continue:
+            self._app.after_idle(self._disconnected)
+
+    def _disconnected(self):
+        # Not a disconnect if the manager was stopped in the meantime (e.g. the client closed the socket)
+        if self._continue and self._on_disconnect is not None:
+            self._on_disconnect()
+
     def request(self, req: Request, callback: Callable[[Request], None]):
         """
         Send a request to the server. The callback will be called when a response
@@ -135,6 +177,9 @@ class RequestManager():
         """
         wrapped = RequestWrapper(req, self._current_id, callback)
         self._current_id = (self._current_id + 1) % MAX_ID
+        if self._stopped:
+            self._fail(wrapped)
+            return
         with self._send_lock:
             with self._sender_condition:
                 self._requests.put(wrapped)
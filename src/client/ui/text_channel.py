@@ -15,10 +15,11 @@ from src.client.message_manager import THRESHOLD, MessageManager
 from src.client.ui.design import ATTACHMENT_ICON_DARK, ATTACHMENT_ICON_LIGHT
 from src.client.ui.loadable_image import LoadableImage
 from src.client.ui.message_frame import MessageFrame
+from src.shared import snowflake
 from src.shared.attachment import MAX_SIZE as ATTACHMENT_MAX_SIZE
 from src.shared.attachment import Attachment, AttachmentType
 from src.shared.channel import Channel, ChannelType
-from src.shared.message import MAX_MESSAGE_LENGTH, TAG_BYTE_LENGTH, Message
+from src.shared.message import MAX_MESSAGE_LENGTH, Message
 
 ENTRY_COLOR = "#303030"
 HOVER_COLOR = "#727272"
@@ -346,9 +347,9 @@ class TextChannel(CTkFrame):
             return
         # Temporary message object (need confirmation from server)
         try:
-            t = int(datetime.now().timestamp())
-            staged_message = Message(t << TAG_BYTE_LENGTH, self._channel.id, self._entry.get(), self._attachment,
-                                     self._client.user, t)
+            id = snowflake.make_id(int(datetime.now().timestamp() * 1000))
+            staged_message = Message(id, self._channel.id, self._entry.get(), self._attachment,
+                                     self._client.user, snowflake.timestamp(id))
         except ValueError:
             logger.warning("Failed to create message object")
             return
@@ -1,31 +1,27 @@
-from datetime import datetime as dt
+import dataclasses
 from hashlib import md5
 from io import BytesIO
-from threading import Lock
+from typing import BinaryIO
 
 from loguru import logger
 import PIL
 from PIL import Image
 
-from src.server import db
+from src.server import db, message_writer, page_cache
 from src.shared import (Attachment, AttachmentType, Channel, ChannelType,
                         Guild, Message, User, attachment)
-from src.shared.abs_data_class import TAG_LENGTH
+from src.shared import snowflake
 
-lock = Lock()
-tag = 0
+id_generator = snowflake.SnowflakeGenerator(snowflake.default_worker_id())
+logger.info(f"Generating ids with worker id {id_generator.worker_id}")
 
 
 def get_id() -> int:
-    global tag
-    with lock:
-        id = (int(dt.now().timestamp()) << TAG_LENGTH) + tag
-        tag = (tag + 1) % (2 ** TAG_LENGTH)
-        return id
+    return id_generator.next_id()
 
 
 def generate_guild(name: str, owner_id: int) -> Guild:
-    if db.users.find_one({"_id": owner_id}) is None:
+    if not db.does_user_exist(owner_id):
         raise ValueError(f"User with id {owner_id} does not exist")
 
     join_code = db.get_random_hex_code()
@@ -34,10 +30,9 @@ def generate_guild(name: str, owner_id: int) -> Guild:
 
     g = Guild(get_id(), name, owner_id)
     d = g.to_db_dict()
-    d["users"] = []
     d["join_code"] = join_code
     db.guilds.insert_one(d)
-    db.user_join_guild(owner_id, g.id)
+    db.user_join_guild(owner_id, g.id, trusted=True)
     return g
 
 
@@ -52,23 +47,36 @@ def generate_channel(name: str, channel_type: ChannelType, guild_id: int) -> Cha
 
 def generate_user(name: str, password_hash: str, name_color: str) -> User:
     u = User(get_id(), name, name_color)
-    d = u.to_db_dict()
-    d["joined_guilds"] = []
-    db.users.insert_one(d)
+    db.users.insert_one(u.to_db_dict())
     db.passwords.insert_one({"_id": u.id, "password_hash": password_hash})
     return u
 
 
-def generate_message(channel_id: int, content: str, author: User, attachment: Attachment | None) -> Message:
-    if db.channels.find_one({"_id": channel_id}) is None:
-        raise ValueError(f"Channel with id {channel_id} does not exist")
-    if db.users.find_one({"_id": author.id}) is None:
-        raise ValueError(f"User {author} does not exist")
-    if attachment is not None and db.attachments.find_one({"_id": attachment.id}) is None:
-        raise ValueError(f"Attachment {attachment} does not exist")
+def generate_message(channel_id: int, content: str, author: User, attachment: Attachment | None,
+                     trusted: bool = False) -> Message:
+    """
+    Store a new message.
+
+    Unless `trusted` is set, the author and the attachment are checked to exist first.
+    Trusted callers (e.g. a send from an authenticated session) must pass an author
+    and an attachment that came from the database.
+    """
+    if not trusted:
+        if not db.does_user_exist(author.id):
+            raise ValueError(f"User {author} does not exist")
+        if attachment is not None and not db.does_attachment_exist(attachment.id):
+            raise ValueError(f"Attachment {attachment} does not exist")
 
     id = get_id()
-    m = Message(id, channel_id, content, attachment, author, id >> TAG_LENGTH)
+    # Validated (content length...) before the sequence number is reserved,
+    # so that invalid messages don't leave gaps in the sequence
+    m = Message(id, channel_id, content, attachment, author, snowflake.timestamp(id))
+
+    seq = db.next_message_seq(channel_id)
+    if seq is None:
+        raise ValueError(f"Channel with id {channel_id} does not exist")
+    m = dataclasses.replace(m, seq=seq)
+
     # Convert the author object to author_id to store in the database
     d = m.to_db_dict()
     del d["author"]
@@ -81,18 +89,22 @@ def generate_message(channel_id: int, content: str, author: User, attachment: At
     else:
         d["attachment_id"] = None
 
-    db.messages.insert_one(d)
+    message_writer.write(d)
+    page_cache.add_message(m)
     return m
 
 
-def generate_attachment(data: bytes, attachment_type: AttachmentType, name: str) -> Attachment:
-    if len(data) > attachment.MAX_SIZE:
-        raise ValueError(f"Attachment data is too large ({len(data)} > {attachment.MAX_SIZE})")
-
+def analyze_attachment(file: BinaryIO, attachment_type: AttachmentType) -> tuple[int, int]:
+    """
+    Returns the width and height of the attachment (0, 0 if it's not an image).
+    Only the header of the file is read.
+    
+    Raises a ValueError if the attachment is an invalid or a too large image.
+    """
     width, height = 0, 0
     if attachment_type == AttachmentType.IMAGE:
         try:
-            image = Image.open(BytesIO(data))
+            image = Image.open(file)
             width, height = image.size
         except (FileNotFoundError, PIL.UnidentifiedImageError, ValueError, TypeError) as e:
             logger.exception('Failed to analyze image')
@@ -102,6 +114,14 @@ def generate_attachment(data: bytes, attachment_type: AttachmentType, name: str)
         raise ValueError(f"Width is too large ({width} > {attachment.MAX_WIDTH})")
     elif height > attachment.MAX_HEIGHT:
         raise ValueError(f"Height is too large ({height} > {attachment.MAX_HEIGHT})")
+    return width, height
+
+
+def generate_attachment(data: bytes, attachment_type: AttachmentType, name: str) -> Attachment:
+    if len(data) > attachment.MAX_SIZE:
+        raise ValueError(f"Attachment data is too large ({len(data)} > {attachment.MAX_SIZE})")
+
+    width, height = analyze_attachment(BytesIO(data), attachment_type)
 
     # Check if the attachment already exists
     hash = md5(data).hexdigest()
@@ -113,5 +133,6 @@ def generate_attachment(data: bytes, attachment_type: AttachmentType, name: str)
     a = Attachment(id, name, attachment_type, width, height, len(data))
     db.attachments.put(data, _id=id, filename=name, attachment_type=attachment_type.value, width=width, height=height,
                        hash=hash)
+    db.cache_attachment(a, hash)
 
     return a
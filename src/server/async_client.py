@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+from src.shared import Request, RequestType, User
+from src.shared import protocol
+from src.shared.protocol import RequestWrapper
+from src.server import channel_subscription
+from src.server.outbound_queue import OutboundQueue
+from src.server.client import (BARRIER_REQUEST_TYPES, ORDERED_REQUEST_TYPES,
+                               REQUEST_WORKERS, STRICT_ORDERING)
+
+# Request handlers (and so the Mongo calls) are blocking, so they run
+# in a shared, bounded pool instead of a thread per connection
+DB_WORKERS = int(os.getenv("LYTECORD_DB_WORKERS", "32"))
+executor = ThreadPoolExecutor(max_workers=DB_WORKERS, thread_name_prefix="Request worker")
+
+
+class AsyncClient():
+    """
+    Represents a client connection to the asyncio server.
+
+    Exposes the same interface as `src.server.client.Client`, so the request
+    handler and the channel subscriptions work with both.
+
+    Attributes:
+    - name: The address/port of the client
+    - user: The user object that the client is currently authenticated as
+    - current_channel: The channel subscription that the client is currently subscribed to
+    - protocol_version: The wire protocol version used by the client
+    - _reader/_writer: The asyncio streams of the connection
+    - _response_queue: The (bounded) queue of responses to send to the client
+    - _wake_up: Set when there are responses to send (or the connection is closing)
+    - _loop: The event loop the connection runs on
+    """
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._reader = reader
+        self._writer = writer
+        self.name: str = writer.get_extra_info("peername")
+        self.user: User | None = None
+        self.current_channel: channel_subscription.ChannelSubscription | None = None
+        self._response_queue: OutboundQueue = OutboundQueue(self.name)
+        self._wake_up: asyncio.Event = asyncio.Event()
+        self._closing: bool = False
+        self._disconnecting: bool = False
+        self._loop = asyncio.get_running_loop()
+        # Detected when the client connects (see protocol.server_handshake_async)
+        self.protocol_version: int = 1
+
+    async def _receiver(self):
+        in_flight: set[asyncio.Task] = set()
+        # Limits the number of requests handled concurrently for this connection
+        slots = asyncio.Semaphore(REQUEST_WORKERS)
+        # Keeps ORDERED_REQUEST_TYPES in order (waiters acquire in FIFO order)
+        ordered_lock = asyncio.Lock()
+
+        async def run(request: Request, req_id: int, subbed: bool, ordered: bool):
+            try:
+                if ordered:
+                    async with ordered_lock:
+                        await self._handle(request, req_id, subbed)
+                else:
+                    await self._handle(request, req_id, subbed)
+            finally:
+                slots.release()
+
+        async def dispatch(request: Request, req_id: int, subbed: bool):
+            if STRICT_ORDERING or request.request_type in BARRIER_REQUEST_TYPES:
+                if in_flight:
+                    await asyncio.wait(in_flight)
+                await self._handle(request, req_id, subbed)
+                return
+
+            await slots.acquire()
+            task = asyncio.create_task(run(request, req_id, subbed, request.request_type in ORDERED_REQUEST_TYPES))
+            in_flight.add(task)
+            task.add_done_callback(in_flight.discard)
+
+        try:
+            self.protocol_version, first_request = await protocol.server_handshake_async(self._reader, self._writer)
+            if first_request is not None:
+                await dispatch(*first_request)
+
+            while True:
+                request, req_id, subbed = await protocol.receive_async(self._reader, self.protocol_version)
+                await dispatch(request, req_id, subbed)
+        except protocol.SocketClosedException:
+            return
+        except protocol.ProtocolException as e:
+            logger.warning(f"Protocol error, closing client: {e}")
+        finally:
+            if in_flight:
+                await asyncio.wait(in_flight)
+
+    async def _handle(self, request: Request, req_id: int, subbed: bool):
+        """
+        Handle a single request in the executor and queue its response (tagged with the request id).
+        """
+        # Circular import fix
+        from src.server import request_handler
+
+        try:
+            response = await self._loop.run_in_executor(executor, request_handler.handle_request, request, req_id,
+                                                        subbed, self)
+        # pylint: disable=broad-except
+        except Exception as e:
+            logger.exception(f"Caught unexpected exception while handling request: {e}")
+            response = Request(RequestType.ERROR, {"message": "Internal server error"})
+
+        self.add_response(RequestWrapper(response, req_id, None, subbed))
+        if request.request_type == RequestType.CHANNEL_SUBSCRIPTION and self.current_channel is not None:
+            # Send missed messages (if any) only after the subscription is confirmed
+            await self._loop.run_in_executor(executor, self.current_channel.wake_up)
+
+    def add_response(self, wrapped: RequestWrapper, droppable: bool = False) -> bool:
+        """
+        Queue a response to be sent to the client.
+        Safe to call from any thread.
+        Droppable responses (new messages) may be dropped if the client is too slow
+        (see outbound_queue). Returns whether the response was queued.
+        """
+        queued = self._response_queue.put(wrapped, self.protocol_version, droppable)
+        try:
+            if self._response_queue.overflowed and not self._disconnecting:
+                self._disconnecting = True
+                logger.warning(f"Client {self.name} is too slow, disconnecting")
+                # Ends the receiver, which closes the connection
+                self._loop.call_soon_threadsafe(self._writer.transport.abort)
+            self._loop.call_soon_threadsafe(self._wake_up.set)
+        except RuntimeError:
+            # The event loop is already closed
+            pass
+        return queued
+
+    async def _sender(self):
+        while True:
+            await self._wake_up.wait()
+            self._wake_up.clear()
+            while (frame := self._response_queue.get()) is not None:
+                await protocol.send_async(frame.wrapped, self._writer, self.protocol_version, frame.parts)
+            if self._closing:
+                return
+
+    async def main_handler(self):
+        sender = asyncio.create_task(self._sender())
+        try:
+            await self._receiver()
+        # pylint: disable=broad-except
+        except Exception as _:
+            logger.exception("Caught exception in receiver")
+        finally:
+            logger.info("Closing client")
+            self._closing = True
+            self._wake_up.set()
+            try:
+                await sender
+            # pylint: disable=broad-except
+            except Exception as _:
+                pass
+            if self.current_channel:
+                # Circular import fix
+                from src.server import channel_manager
+                await self._loop.run_in_executor(executor, channel_manager.unsubscribe, self.current_channel)
+            try:
+                self._writer.close()
+                await self._writer.wait_closed()
+            # pylint: disable=broad-except
+            except Exception as _:
+                pass
+            logger.success("Closed client")
@@ -0,0 +1,82 @@
+"""
+Caches the role of users in guilds, so permission checks (e.g. "is this user the owner
+of the guild?") don't query the database in steady state.
+
+The roles of a user are loaded when they log in, and are updated when they create or join
+a guild. Entries expire after AUTHORIZATION_TTL seconds, so changes made by other server
+processes are eventually picked up.
+
+Attributes:
+- OWNER/MEMBER: The roles of a user in a guild (None means not a member, or no such guild)
+
+Functions:
+- get_role: Returns the role of a user in a guild
+- load_user: Caches the roles of a user in all their guilds
+- set_role: Caches the role of a user in a guild (after a membership change)
+- invalidate: Removes the cached role of a user in a guild
+- invalidate_guild: Removes the cached roles of every user in a guild
+- stats: Returns the cache counters
+"""
+import os
+
+from src.server import db
+from src.server.cache import LRUCache
+from src.shared.guild import Guild
+
+OWNER = "owner"
+MEMBER = "member"
+
+AUTHORIZATION_CACHE_SIZE = int(os.getenv("LYTECORD_AUTHORIZATION_CACHE_SIZE", "100000"))
+AUTHORIZATION_TTL = float(os.getenv("LYTECORD_AUTHORIZATION_TTL", "300"))
+
+# (user id, guild id) -> role, or None if the user is not in the guild
+roles: LRUCache[tuple[int, int], str | None] = LRUCache(AUTHORIZATION_CACHE_SIZE, AUTHORIZATION_TTL)
+_MISSING = object()
+
+
+def get_role(user_id: int, guild_id: int) -> str | None:
+    """
+    Returns OWNER or MEMBER, or None if the user is not in the guild (or the guild doesn't exist).
+    """
+    role = roles.get((user_id, guild_id), _MISSING)
+    if role is not _MISSING:
+        return role
+
+    role = None
+    if db.is_user_in_guild(user_id, guild_id):
+        try:
+            role = OWNER if db.get_guild_owner(guild_id) == user_id else MEMBER
+        except KeyError:
+            # The guild was deleted
+            pass
+    roles.put((user_id, guild_id), role)
+    return role
+
+
+def load_user(user_id: int) -> list[Guild]:
+    """
+    Cache the roles of the user in all their guilds, and return the guilds.
+    """
+    guilds = db.get_user_guilds(user_id)
+    for guild in guilds:
+        roles.put((user_id, guild.id), OWNER if guild.owner_id == user_id else MEMBER)
+    return guilds
+
+
+def set_role(user_id: int, guild_id: int, role: str | None):
+    roles.put((user_id, guild_id), role)
+
+
+def invalidate(user_id: int, guild_id: int):
+    roles.invalidate((user_id, guild_id))
+
+
+def invalidate_guild(guild_id: int):
+    """
+    Remove the cached roles of every user in the guild (e.g. when its owner changes or it is deleted).
+    """
+    roles.invalidate_matching_keys(lambda key: key[1] == guild_id)
+
+
+def stats() -> dict[str, int]:
+    return roles.stats()
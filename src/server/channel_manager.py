@@ -1,39 +1,107 @@
+"""
+Keeps the message publisher of every channel that has (or recently had) subscribers.
+
+A publisher whose last subscriber left is kept idle (with its buffer warm) for
+PUBLISHER_IDLE_TTL seconds, so switching back to a channel doesn't start from
+the database. Idle publishers are evicted least recently used first once there
+are more than MAX_IDLE_PUBLISHERS of them or they buffer more than
+IDLE_BUFFER_BUDGET messages in total.
+
+Functions:
+- subscribe: Subscribes a client to a channel
+- unsubscribe: Unsubscribes a client from a channel
+- stats: Returns the publisher counters (warm hits, cold creates, evictions...)
+"""
+import os
 import threading
+import time
+from collections import OrderedDict
 
 from loguru import logger
 
 from src.server.channel_subscription import ChannelSubscription
 from src.server.message_publisher import MessagePublisher
 
+PUBLISHER_IDLE_TTL = float(os.getenv("LYTECORD_PUBLISHER_IDLE_TTL", "300"))
+MAX_IDLE_PUBLISHERS = int(os.getenv("LYTECORD_MAX_IDLE_PUBLISHERS", "1000"))
+IDLE_BUFFER_BUDGET = int(os.getenv("LYTECORD_IDLE_BUFFER_BUDGET", "20000"))
+
 lock = threading.Lock()
 publishers: dict[int, MessagePublisher] = {}
+# Channel ids of the publishers without subscribers, by when they became idle (oldest first),
+# with the number of messages they buffered then
+idle: OrderedDict[int, tuple[float, int]] = OrderedDict()
+# Total of the buffered counts in idle (kept up to date, instead of summed on every eviction check)
+idle_buffered = 0
+counters = {"warm": 0, "cold": 0, "evicted": 0}
+
 
-def subscribe(client_sub: ChannelSubscription, last_message_id: int = 0):
+def subscribe(client_sub: ChannelSubscription, last_seq: int = 0):
     """
-    Subscribe a client to a channel.
+    Subscribe a client to a channel, sending it the messages after `last_seq`.
     If the channel publisher does not exist, it will be created.
     """
+    global idle_buffered
     channel_id = client_sub.channel.id
     with lock:
+        _evict()
         if channel_id not in publishers:
             publishers[channel_id] = MessagePublisher(client_sub.channel)
-        publishers[channel_id].add_subscription(client_sub)
+            counters["cold"] += 1
+        elif channel_id in idle:
+            idle_buffered -= idle.pop(channel_id)[1]
+            counters["warm"] += 1
+        publisher = publishers[channel_id]
+        publisher.add_subscription(client_sub)
 
-    client_sub.begin(publishers[channel_id], last_message_id)
+    client_sub.begin(publisher, last_seq)
     logger.success(f"Client {client_sub.client.name} subscribed to channel {client_sub.channel.name}")
-    return publishers[channel_id]
+    return publisher
 
 
 def unsubscribe(client_sub: ChannelSubscription):
     """
     Unsubscribe a client from a channel.
-    If the channel publisher is empty, it will be deleted.
+    If the channel publisher is empty, it is kept idle (see PUBLISHER_IDLE_TTL).
     """
+    global idle_buffered
     channel_id = client_sub.channel.id
     with lock:
         if channel_id in publishers:
             publishers[channel_id].remove_subscription(client_sub)
             if publishers[channel_id].is_empty():
-                del publishers[channel_id]
+                if channel_id in idle:
+                    idle_buffered -= idle.pop(channel_id)[1]
+                buffered = publishers[channel_id].buffered_count()
+                idle[channel_id] = (time.monotonic(), buffered)
+                idle_buffered += buffered
+        _evict()
     client_sub.stop()
-    logger.success(f"Client {client_sub.client.name} unsubscribed from channel {client_sub.channel.name}")
\ No newline at end of file
+    logger.success(f"Client {client_sub.client.name} unsubscribed from channel {client_sub.channel.name}")
+
+
+def _evict():
+    """
+    Delete idle publishers that expired or are over the budget (least recently used first).
+    Should be called with the lock acquired.
+
+    The budget uses the buffered counts of the publishers when they became idle.
+    """
+    global idle_buffered
+    now = time.monotonic()
+    while idle:
+        channel_id, (since, buffered) = next(iter(idle.items()))
+        if (now - since <= PUBLISHER_IDLE_TTL and len(idle) <= MAX_IDLE_PUBLISHERS
+                and idle_buffered <= IDLE_BUFFER_BUDGET):
+            break
+
+        del idle[channel_id]
+        idle_buffered -= buffered
+        del publishers[channel_id]
+        counters["evicted"] += 1
+        logger.debug(f"Evicted idle publisher of channel {channel_id}")
+
+
+def stats() -> dict[str, int]:
+    with lock:
+        return {"active": len(publishers) - len(idle), "idle": len(idle), "idle_buffered": idle_buffered, **counters}
@@ -1,5 +1,7 @@
 from __future__ import annotations
+import os
 import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from loguru import logger
 
@@ -8,14 +10,24 @@ from src.server import client
 from src.shared.channel import Channel
 from src.shared.message import Message
 from src.shared.protocol import RequestWrapper
-from src.shared.request import Request, RequestType
+from src.shared.request import Request
+
+# Subscriptions don't have threads of their own: new messages are pushed into the clients'
+# response queues either inline (by the thread that broadcasts the message) or, if
+# FANOUT_WORKERS > 0, by a small shared pool, in batches of FANOUT_BATCH_SIZE subscriptions
+FANOUT_WORKERS = int(os.getenv("LYTECORD_FANOUT_WORKERS", "0"))
+FANOUT_BATCH_SIZE = int(os.getenv("LYTECORD_FANOUT_BATCH_SIZE", "256"))
+dispatcher: ThreadPoolExecutor | None = None
+if FANOUT_WORKERS > 0:
+    dispatcher = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="Fan-out worker")
 
 
 class ChannelSubscription():
-    """ 
+    """
     Handles the subscription of a client to a channel.
-    
-    Runs in a separate thread to send messages to the client.
+
+    A plain state object: the publisher calls `wake_up`, which pushes the
+    messages the client hasn't received yet into the client's response queue.
     """
     def __init__(self, client: client.Client, subscription_id: int, channel: Channel):
         self.client = client
@@ -23,73 +35,88 @@ class ChannelSubscription():
         self._id: int = subscription_id
         self.channel: Channel = channel
         self.publisher: message_publisher.MessagePublisher | None = None
-        self._last_message_id: int = 0
+        # The sequence number of the last message the client has
+        self._last_seq: int = 0
+        # Sequence numbers of messages sent by the client itself (which it already has)
+        self._sent_seqs: set[int] = set()
         self._stop: bool = False
-        self._thread: threading.Thread = threading.Thread(target=self._run, daemon=True)
-        self._thread.name = f"Channel subscription thread {client.name}"
-        self._condition: threading.Condition = threading.Condition()
-        self._startup_event: threading.Event = threading.Event()
-
-    def begin(self, publisher: message_publisher.MessagePublisher, last_message_id: int = 0):
-        if not self._stop and not self._startup_event.is_set():
-            self._last_message_id = last_message_id
-            self._thread.start()
-            self.publisher = publisher
-            # Wait for the thread to start, to avoid race conditions
-            self._startup_event.wait()
+        # Serializes flushes, so messages are sent in order and only once
+        self._lock: threading.Lock = threading.Lock()
+
+    def begin(self, publisher: message_publisher.MessagePublisher, last_seq: int = 0):
+        with self._lock:
+            if not self._stop:
+                self._last_seq = last_seq
+                self.publisher = publisher
 
     def stop(self):
-        with self._condition:
+        with self._lock:
             self._stop = True
             self.publisher = None
-            self._condition.notify()
-        self._thread.join()
-
-    def _run(self):
-        with self._condition:
-            self._startup_event.set()
-            while not self._stop:
-                # Wait for the publisher to wake up the thread
-                self._condition.wait()
-                if self._stop:
-                    break
-
-                if not self.publisher:
-                    continue
-
-                messages = self.publisher.get_messages(self._last_message_id)
-                if len(messages) == 0:
-                    continue
-
-                # Send each message in a separate response
-                for message in messages[::-1]:
-                    self.client.add_response(self.create_response(message))
-                self._last_message_id = messages[0].id if len(messages) > 0 else self._last_message_id
-
-    def create_response(self, message: Message) -> RequestWrapper:
+
+    def create_response(self, request: Request) -> RequestWrapper:
         """
-        Create a response for the given message.
+        Wrap a (shared) message response for this subscription.
         """
-        request = Request(RequestType.CHANNEL_SUBSCRIPTION, {"message": message})
-        wrapped = RequestWrapper(request, self._id, None, True)
-        return wrapped
+        return RequestWrapper(request, self._id, None, True)
 
     def wake_up(self):
         """
-        Wake up the subscription thread.
+        Send the messages the client hasn't received yet (if any).
         """
-        with self._condition:
-            self._condition.notify()
+        with self._lock:
+            if self._stop or not self.publisher:
+                return
+
+            # Send each message in a separate response, in order
+            for messages in self.publisher.get_message_batches(self._last_seq):
+                for message in messages:
+                    if message.seq in self._sent_seqs:
+                        self._sent_seqs.discard(message.seq)
+                    elif message.seq > self._last_seq:
+                        if not self.client.add_response(self.create_response(self.publisher.get_response(message)),
+                                                        droppable=True):
+                            # The client fell behind and will resync (or is disconnected),
+                            # so the rest of the backlog isn't read
+                            self._last_seq = max(self._last_seq, self.publisher.last_seq())
+                            self._sent_seqs.clear()
+                            return
+                    self._last_seq = max(self._last_seq, message.seq)
+            self._sent_seqs = {seq for seq in self._sent_seqs if seq > self._last_seq}
 
     def send_message(self, message: Message):
         """
         Send a message to the channel.
         Notifies the publisher to broadcast the message.
         """
-        if not self.publisher:
+        publisher = self.publisher
+        if not publisher:
             logger.warning("Tried to send message to None channel, please set publisher first")
             return False
 
-        self._last_message_id = message.id
-        self.publisher.broadcast(message, self)
+        with self._lock:
+            # Not delivered back to the client, but messages before it still are
+            self._sent_seqs.add(message.seq)
+        publisher.broadcast(message, self)
         return True
+
+
+def _wake_up_all(subscriptions: list[ChannelSubscription]):
+    for sub in subscriptions:
+        try:
+            sub.wake_up()
+        # pylint: disable=broad-except
+        except Exception as e:
+            logger.exception(f"Failed to send messages to {sub.client.name}: {e}")
+
+
+def fan_out(subscriptions: list[ChannelSubscription]):
+    """
+    Wake up the given subscriptions, inline or in the dispatcher pool (see FANOUT_WORKERS).
+    """
+    if dispatcher is None:
+        _wake_up_all(subscriptions)
+        return
+
+    for i in range(0, len(subscriptions), FANOUT_BATCH_SIZE):
+        dispatcher.submit(_wake_up_all, subscriptions[i:i + FANOUT_BATCH_SIZE])
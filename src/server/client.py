@@ -1,7 +1,9 @@
 from __future__ import annotations
 
+import os
 import threading
-from queue import Queue
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import socket
 from ssl import SSLSocket
 
 from loguru import logger
@@ -9,7 +11,19 @@ from loguru import logger
 from src.shared import Request, RequestType, User
 from src.shared import protocol
 from src.shared.protocol import RequestWrapper
-from src.server import channel_subscription 
+from src.server import channel_subscription
+from src.server.outbound_queue import OutboundQueue
+
+# Maximum number of requests handled concurrently for a single connection
+REQUEST_WORKERS = int(os.getenv("LYTECORD_REQUEST_WORKERS", "4"))
+# Handle every request in the order it was received (one at a time)
+STRICT_ORDERING = os.getenv("LYTECORD_STRICT_ORDERING", "0") == "1"
+# Requests that wait for all previous requests to finish, and block
+# later requests until they are done (they change the connection's state)
+BARRIER_REQUEST_TYPES = {RequestType.AUTHENTICATE, RequestType.CHANNEL_SUBSCRIPTION}
+# Requests that are handled in order relative to each other,
+# but concurrently with other requests
+ORDERED_REQUEST_TYPES = {RequestType.SEND_MESSAGE}
 
 
 class Client():
@@ -20,50 +34,106 @@ class Client():
     - socket: The socket object representing the connection
     - name: The address/port of the client
     - user: The user object that the client is currently authenticated as
-    - _response_queue: A queue of responses to send to the client
+    - _response_queue: The (bounded) queue of responses to send to the client
     - _condition: A condition variable to notify the main handler thread
     - _stop: A flag to stop the main handler thread
     - current_channel: The channel subscription that the client is currently subscribed to
+    - protocol_version: The wire protocol version used by the client
+    - _workers: Handles the requests of this connection concurrently
+    - _ordered_worker: Handles ORDERED_REQUEST_TYPES one after another
     """
 
     def __init__(self, socket: SSLSocket):
         self._socket: SSLSocket = socket
         self.name: str = socket.getpeername()
         self.user: User | None = None
-        self._response_queue: Queue[RequestWrapper] = Queue()
+        self._response_queue: OutboundQueue = OutboundQueue(self.name)
         self._condition: threading.Condition = threading.Condition()
         self._stop: bool = False
         self.current_channel: channel_subscription.ChannelSubscription | None = None
+        # Detected when the client connects (see protocol.server_handshake)
+        self.protocol_version: int = 1
+        self._workers = ThreadPoolExecutor(max_workers=REQUEST_WORKERS,
+                                           thread_name_prefix=f"Client worker; port: {self.name[1]}")
+        self._ordered_worker = ThreadPoolExecutor(max_workers=1,
+                                                  thread_name_prefix=f"Client ordered worker; port: {self.name[1]}")
 
     def _receiver_thread(self):
-        while not self._stop:
-            try:
-                request, req_id, subbed = protocol.receive(self._socket)
-            except protocol.SocketClosedException:
-                self._stop = True
-                with self._condition:
-                    self._condition.notify()
-                return
-
-            # Circular import fix
-            from src.server import request_handler
-
-            try:
-                response = request_handler.handle_request(request, req_id, subbed, self)
-            # pylint: disable=broad-except
-            except Exception as e:
-                logger.exception(f"Caught unexpected exception in receiver thread: {e}")
-                response = Request(RequestType.ERROR, {"message": "Internal server error"})
+        in_flight: set[Future] = set()
+        try:
+            self.protocol_version, first_request = protocol.server_handshake(self._socket)
+            if first_request is not None:
+                self._dispatch(*first_request, in_flight)
 
-            wrapped = RequestWrapper(response, req_id, None, subbed)
-            self._response_queue.put(wrapped)
+            while not self._stop:
+                request, req_id, subbed = protocol.receive(self._socket, self.protocol_version)
+                self._dispatch(request, req_id, subbed, in_flight)
+        except (protocol.SocketClosedException, protocol.ProtocolException) as e:
+            if isinstance(e, protocol.ProtocolException):
+                logger.warning(f"Protocol error, closing client: {e}")
+            self._stop = True
             with self._condition:
                 self._condition.notify()
+        finally:
+            self._workers.shutdown(wait=True)
+            self._ordered_worker.shutdown(wait=True)
+
+    def _dispatch(self, request: Request, req_id: int, subbed: bool, in_flight: set[Future]):
+        """
+        Handle the request inline or in one of the workers, depending on its type.
+        """
+        if STRICT_ORDERING or request.request_type in BARRIER_REQUEST_TYPES:
+            wait(list(in_flight))
+            self._handle(request, req_id, subbed)
+            return
+
+        if request.request_type in ORDERED_REQUEST_TYPES:
+            future = self._ordered_worker.submit(self._handle, request, req_id, subbed)
+        else:
+            future = self._workers.submit(self._handle, request, req_id, subbed)
+        in_flight.add(future)
+        future.add_done_callback(in_flight.discard)
+
+    def _handle(self, request: Request, req_id: int, subbed: bool):
+        """
+        Handle a single request and queue its response (tagged with the request id).
+        """
+        # Circular import fix
+        from src.server import request_handler
 
-    def add_response(self, wrapped: RequestWrapper):
-        self._response_queue.put(wrapped)
+        try:
+            response = request_handler.handle_request(request, req_id, subbed, self)
+        # pylint: disable=broad-except
+        except Exception as e:
+            logger.exception(f"Caught unexpected exception while handling request: {e}")
+            response = Request(RequestType.ERROR, {"message": "Internal server error"})
+
+        self.add_response(RequestWrapper(response, req_id, None, subbed))
+        if request.request_type == RequestType.CHANNEL_SUBSCRIPTION and self.current_channel is not None:
+            # Send missed messages (if any) only after the subscription is confirmed
+            self.current_channel.wake_up()
+
+    def add_response(self, wrapped: RequestWrapper, droppable: bool = False) -> bool:
+        """
+        Queue a response to be sent to the client.
+        Droppable responses (new messages) may be dropped if the client is too slow
+        (see outbound_queue). Returns whether the response was queued.
+        """
+        queued = self._response_queue.put(wrapped, self.protocol_version, droppable)
+        if self._response_queue.overflowed and not self._stop:
+            logger.warning(f"Client {self.name} is too slow, disconnecting")
+            self._disconnect()
         with self._condition:
             self._condition.notify()
+        return queued
+
+    def _disconnect(self):
+        self._stop = True
+        try:
+            # Unblocks the receiver and sender threads
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
 
     def main_handler(self):
         receiver_thread = threading.Thread(target=self._receiver_thread, daemon=True)
@@ -71,20 +141,20 @@ class Client():
 
         try:
             receiver_thread.start()
-            with self._condition:
-                try:
-                    while not self._stop:
-                        self._condition.wait_for(lambda: not self._response_queue.empty() or self._stop)
-                        if self._stop:
-                            break
-
-                        while not self._response_queue.empty():
-                            response = self._response_queue.get()
-                            protocol.send(response, self._socket)
-                # pylint: disable=broad-except
-                except Exception as _:
-                    logger.error("Caught exception in main handler")
-                    self._stop = True
+            try:
+                while not self._stop:
+                    with self._condition:
+                        self._condition.wait_for(lambda: len(self._response_queue) > 0 or self._stop)
+                    if self._stop:
+                        break
+
+                    # Sent without holding the condition, so a slow client doesn't block add_response
+                    while (frame := self._response_queue.get()) is not None:
+                        protocol.send(frame.wrapped, self._socket, self.protocol_version, frame.parts)
+            # pylint: disable=broad-except
+            except Exception as _:
+                logger.error("Caught exception in main handler")
+                self._stop = True
 
         # pylint: disable=broad-except
         except Exception as _:
@@ -93,7 +163,9 @@ class Client():
             logger.info("Closing client")
             receiver_thread.join()
             if self.current_channel:
-                self.current_channel.stop()
+                # Circular import fix
+                from src.server import channel_manager
+                channel_manager.unsubscribe(self.current_channel)
             try:
                 self._socket.close()
             # pylint: disable=broad-except
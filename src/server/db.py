@@ -2,15 +2,19 @@ import random
 import string
 import sys
 import os
+from collections.abc import Iterable
+from dataclasses import dataclass
 
 from dotenv import load_dotenv
 import gridfs
 from loguru import logger
 import pymongo
-from pymongo import MongoClient
+from pymongo import MongoClient, ReturnDocument
 import pymongo.collation
 from pymongo.collection import Collection
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 
+from src.server.cache import LRUCache
 from src.shared import (AbsDataClass, Attachment, AttachmentType, Channel,
                         ChannelType, Guild, Message, User, attachment)
 
@@ -20,16 +24,39 @@ USER = os.getenv("MONGO_USER")
 PASSWORD = os.getenv("MONGO_PASSWORD")
 CONNECTION_STRING = f'mongodb://{USER + ":" + PASSWORD + "@" if USER and PASSWORD else ""}{"mongo" if '-d' in sys.argv else 'localhost'}:27017/?authSource=admin'
 
+DB_NAME = os.getenv("MONGO_DB", "Lytecord")
+
 db_client = MongoClient(CONNECTION_STRING)
-db = db_client["Lytecord"]
+db = db_client[DB_NAME]
 guilds: Collection = db["guilds"]
 channels: Collection = db["channels"]
 users: Collection = db["users"]
 messages: Collection = db["messages"]
 passwords: Collection = db["passwords"]
+memberships: Collection = db["memberships"]
 attachments = gridfs.GridFS(db, "attachments")
+attachments_files: Collection = db["attachments.files"]
 
 CASE_INSENSITIVE_COLLATION = pymongo.collation.Collation(locale="en", strength=2)
+# Only the fields needed to build the objects (e.g. skips the joined guilds of users)
+USER_PROJECTION = {"username": 1, "name_color": 1}
+GUILD_PROJECTION = {"name": 1, "owner_id": 1}
+ATTACHMENT_PROJECTION = {"filename": 1, "attachment_type": 1, "width": 1, "height": 1, "length": 1}
+
+# Users are immutable (for now), so they can be cached for a long time.
+# Cached by id and by case folded username
+USER_CACHE_SIZE = int(os.getenv("LYTECORD_USER_CACHE_SIZE", "10000"))
+USER_CACHE_TTL = float(os.getenv("LYTECORD_USER_CACHE_TTL", "3600"))
+users_by_id: LRUCache[int, User] = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+users_by_name: LRUCache[str, User] = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+# Attachments are content addressed and immutable, so they are cached without a TTL.
+# Ids that don't exist are cached for a short time, to avoid repeated lookups
+ATTACHMENT_CACHE_SIZE = int(os.getenv("LYTECORD_ATTACHMENT_CACHE_SIZE", "10000"))
+MISSING_ATTACHMENT_TTL = float(os.getenv("LYTECORD_MISSING_ATTACHMENT_TTL", "60"))
+attachments_by_id: LRUCache[int, Attachment] = LRUCache(ATTACHMENT_CACHE_SIZE)
+attachment_ids_by_hash: LRUCache[str, int] = LRUCache(ATTACHMENT_CACHE_SIZE)
+missing_attachments: LRUCache[int, bool] = LRUCache(ATTACHMENT_CACHE_SIZE, MISSING_ATTACHMENT_TTL)
 
 
 def convert_id_name(d: dict) -> dict:
@@ -38,12 +65,168 @@ def convert_id_name(d: dict) -> dict:
     return d
 
 
-def create_indexes():
-    messages.create_index("channel_id")
-    users.create_index("username", unique=True, collation=CASE_INSENSITIVE_COLLATION)
-    channels.create_index("guild_id")
-    guilds.create_index("join_code", unique=True)
-    db["attachments.files"].create_index("hash", unique=True)
+@dataclass(frozen=True)
+class IndexSpec:
+    """
+    An index that should exist on a collection.
+    `managed` indexes are created by someone else (e.g. GridFS), and are only registered for drift checks.
+    """
+    collection: str
+    keys: tuple[tuple[str, int], ...]
+    unique: bool = False
+    collation: pymongo.collation.Collation | None = None
+    managed: bool = False
+    # Only documents that match this filter are indexed (queries must imply it to use the index)
+    partial_filter: dict | None = None
+
+    @property
+    def name(self) -> str:
+        # Same as the default name MongoDB gives to indexes
+        return "_".join(f"{field}_{direction}" for field, direction in self.keys)
+
+
+@dataclass(frozen=True)
+class QuerySpec:
+    """
+    The shape of a query that this module runs (with sample values), used to check its plan with explain().
+    """
+    collection: str
+    filter: dict
+    sort: tuple[tuple[str, int], ...] = ()
+    collation: pymongo.collation.Collation | None = None
+
+
+# Every query in this module should be served by one of these indexes (see QUERIES)
+INDEXES: list[IndexSpec] = [
+    # get_messages: find({"channel_id": c, "_id": {"$lt": x}}).sort("_id", -1)
+    IndexSpec("messages", (("channel_id", 1), ("_id", -1))),
+    # next_message_seq assigns the sequence numbers, this makes sure they are never reused
+    # get_messages_after_seq: find({"channel_id": c, "seq": {"$gt": x, "$lt": y}}).sort("seq", 1)
+    IndexSpec("messages", (("channel_id", 1), ("seq", 1)), unique=True, partial_filter={"seq": {"$gt": 0}}),
+    # get_user_by_name, does_user_exist_by_name
+    IndexSpec("users", (("username", 1),), unique=True, collation=CASE_INSENSITIVE_COLLATION),
+    # get_channels
+    IndexSpec("channels", (("guild_id", 1),)),
+    # get_guild_by_code, refresh_guild_join_code
+    IndexSpec("guilds", (("join_code", 1),), unique=True),
+    # is_user_in_guild, and makes user_join_guild atomic
+    IndexSpec("memberships", (("guild_id", 1), ("user_id", 1)), unique=True),
+    # get_user_guilds
+    IndexSpec("memberships", (("user_id", 1), ("guild_id", 1))),
+    # find_attachment_by_hash
+    IndexSpec("attachments.files", (("hash", 1),), unique=True),
+    IndexSpec("attachments.files", (("filename", 1), ("uploadDate", 1)), managed=True),
+    IndexSpec("attachments.chunks", (("files_id", 1), ("n", 1)), unique=True, managed=True),
+]
+
+QUERIES: dict[str, QuerySpec] = {
+    "get_messages (latest)": QuerySpec("messages", {"channel_id": 0}, (("_id", -1),)),
+    "get_messages (before)": QuerySpec("messages", {"channel_id": 0, "_id": {"$lt": 0}}, (("_id", -1),)),
+    "get_messages_after_seq": QuerySpec("messages", {"channel_id": 0, "seq": {"$gt": 0, "$lt": 1}}, (("seq", 1),)),
+    "get_user_by_name": QuerySpec("users", {"username": ""}, collation=CASE_INSENSITIVE_COLLATION),
+    "get_users": QuerySpec("users", {"_id": {"$in": [0]}}),
+    "get_channels": QuerySpec("channels", {"guild_id": 0}),
+    "get_guild_by_code": QuerySpec("guilds", {"join_code": ""}),
+    "is_user_in_guild": QuerySpec("memberships", {"guild_id": 0, "user_id": 0}),
+    "get_user_guilds": QuerySpec("memberships", {"user_id": 0}),
+    "get_attachments": QuerySpec("attachments.files", {"_id": {"$in": [0]}}),
+    "find_attachment_by_hash": QuerySpec("attachments.files", {"hash": ""}),
+}
+
+
+def create_indexes(drop_extra: bool = False, collections: Iterable[str] | None = None):
+    """
+    Create all the registered indexes (only those of the given collections, if any).
+    If drop_extra is True, indexes that are not registered are dropped.
+    """
+    if collections is not None:
+        collections = set(collections)
+    for spec in INDEXES:
+        if spec.managed or (collections is not None and spec.collection not in collections):
+            continue
+        options = {}
+        if spec.partial_filter is not None:
+            options["partialFilterExpression"] = spec.partial_filter
+        db[spec.collection].create_index(list(spec.keys), unique=spec.unique, collation=spec.collation, **options)
+
+    if drop_extra:
+        for collection, name in check_indexes()[1]:
+            if collections is not None and collection not in collections:
+                continue
+            logger.info(f"Dropping unregistered index {name} on {collection}")
+            db[collection].drop_index(name)
+
+
+def check_indexes() -> tuple[list[IndexSpec], list[tuple[str, str]]]:
+    """
+    Compare the registered indexes with the ones in the database.
+    
+    Returns the registered indexes that are missing (or differ), and the
+    (collection, index name) pairs of indexes that are not registered.
+    """
+    missing: list[IndexSpec] = []
+    extra: list[tuple[str, str]] = []
+    for collection in sorted({spec.collection for spec in INDEXES}):
+        existing = db[collection].index_information()
+        registered = {spec.name: spec for spec in INDEXES if spec.collection == collection}
+
+        for name, spec in registered.items():
+            info = existing.get(name)
+            if (info is None or tuple(info["key"]) != spec.keys or info.get("unique", False) != spec.unique
+                    or info.get("partialFilterExpression") != spec.partial_filter):
+                missing.append(spec)
+            elif spec.collation is not None:
+                collation = info.get("collation", {})
+                expected = spec.collation.document
+                if collation.get("locale") != expected["locale"] or collation.get("strength") != expected["strength"]:
+                    missing.append(spec)
+
+        extra.extend((collection, name) for name in existing if name != "_id_" and name not in registered)
+
+    for spec in missing:
+        logger.warning(f"Index {spec.name} on {spec.collection} is missing or differs from the registry")
+    for collection, name in extra:
+        logger.warning(f"Index {name} on {collection} is not registered")
+    return missing, extra
+
+
+def explain_queries() -> dict[str, dict]:
+    """
+    Run explain() on every registered query.
+    
+    Returns the winning plan of each query (by name). Plans with a COLLSCAN or an
+    in-memory SORT stage are logged as warnings, since they aren't served by an index.
+    """
+    plans = {}
+    for name, spec in QUERIES.items():
+        cursor = db[spec.collection].find(spec.filter)
+        if spec.sort:
+            cursor = cursor.sort(list(spec.sort))
+        if spec.collation is not None:
+            cursor = cursor.collation(spec.collation)
+        plan = cursor.explain()["queryPlanner"]["winningPlan"]
+        # The slot based engine nests the plan
+        plan = plan.get("queryPlan", plan)
+        plans[name] = plan
+
+        stages = _plan_stages(plan)
+        if "COLLSCAN" in stages or "SORT" in stages:
+            logger.warning(f"Query {name} is not served by an index (stages: {stages})")
+        else:
+            logger.info(f"Query {name}: {stages}")
+    return plans
+
+
+def _plan_stages(plan: dict) -> list[str]:
+    """
+    Returns the stages of a query plan, from the outermost one.
+    """
+    stages = [plan.get("stage", "")]
+    if "inputStage" in plan:
+        stages += _plan_stages(plan["inputStage"])
+    for child in plan.get("inputStages", []):
+        stages += _plan_stages(child)
+    return stages
 
 
 def get_random_hex_code(length=8):
@@ -51,31 +234,30 @@ def get_random_hex_code(length=8):
 
 
 def get_user_guilds(user_id: int) -> list[Guild]:
-    cursor = users.find_one({"_id": user_id})
-    if not cursor:
+    if not does_user_exist(user_id):
         raise KeyError(f"User with id {user_id} does not exist")
 
-    ids: list[int] = [guild_id for guild_id in cursor["joined_guilds"]]
-    return [Guild.from_db_dict(g) for g in guilds.find({"_id": {"$in": ids}}).max_time_ms(1000)]
+    ids: list[int] = [m["guild_id"] for m in memberships.find({"user_id": user_id}, {"_id": 0, "guild_id": 1})]
+    return [Guild.from_db_dict(g) for g in guilds.find({"_id": {"$in": ids}}, GUILD_PROJECTION).max_time_ms(1000)]
 
 
 def does_guild_exist(guild_id: int) -> bool:
-    return guilds.find_one({"_id": guild_id}) is not None
+    return guilds.find_one({"_id": guild_id}, {"_id": 1}) is not None
 
 
-def _get_guild_raw(guild_id: int) -> dict:
-    result = guilds.find_one({"_id": guild_id})
+def _get_guild_raw(guild_id: int, projection: dict) -> dict:
+    result = guilds.find_one({"_id": guild_id}, projection)
     if result is None:
         raise KeyError(f"Guild with id {guild_id} does not exist")
     return result
 
 
 def get_guild(guild_id: int) -> Guild:
-    return Guild.from_db_dict(_get_guild_raw(guild_id))
+    return Guild.from_db_dict(_get_guild_raw(guild_id, GUILD_PROJECTION))
 
 
 def get_guild_join_code(guild_id: int) -> str:
-    return _get_guild_raw(guild_id)["join_code"]
+    return _get_guild_raw(guild_id, {"join_code": 1})["join_code"]
 
 
 def refresh_guild_join_code(guild_id: int) -> str:
@@ -90,14 +272,14 @@ def refresh_guild_join_code(guild_id: int) -> str:
 
 
 def get_guild_by_code(code: str) -> Guild | None:
-    guild = guilds.find_one({"join_code": code})
+    guild = guilds.find_one({"join_code": code}, GUILD_PROJECTION)
     if guild is None:
         return None
     return Guild.from_db_dict(guild)
 
 
 def get_guild_owner(guild_id: int) -> int:
-    return _get_guild_raw(guild_id)["owner_id"]
+    return _get_guild_raw(guild_id, {"owner_id": 1})["owner_id"]
 
 
 def get_channels(guild_id: int) -> list[Channel]:
@@ -119,49 +301,116 @@ def does_channel_exist(channel_id: int) -> bool:
     return channels.find_one({"_id": channel_id}) is not None
 
 
+def _cache_user(user: User):
+    users_by_id.put(user.id, user)
+    users_by_name.put(user.username.casefold(), user)
+
+
+def invalidate_user(user_id: int):
+    """
+    Remove a user from the cache (call this whenever a user document changes).
+    """
+    users_by_id.invalidate(user_id)
+    users_by_name.invalidate_matching(lambda u: u.id == user_id)
+
+
 def _get_user_raw(user_id: int) -> dict:
-    result = users.find_one({"_id": user_id})
+    result = users.find_one({"_id": user_id}, USER_PROJECTION)
     if result is None:
         raise KeyError(f"User with id {user_id} does not exist")
     return result
 
 
 def get_user(user_id: int) -> User:
-    return User.from_db_dict(_get_user_raw(user_id))
+    user = users_by_id.get(user_id)
+    if user is None:
+        user = User.from_db_dict(_get_user_raw(user_id))
+        _cache_user(user)
+    return user
 
 
 def get_user_by_name(username: str) -> User:
-    result = users.find_one({"username": username}, collation=CASE_INSENSITIVE_COLLATION)
+    user = users_by_name.get(username.casefold())
+    if user is not None:
+        return user
+
+    result = users.find_one({"username": username}, USER_PROJECTION, collation=CASE_INSENSITIVE_COLLATION)
     if result is None:
         raise KeyError(f"User with name {username} does not exist")
-    return User.from_db_dict(result)
+    user = User.from_db_dict(result)
+    _cache_user(user)
+    return user
 
 
 def does_user_exist(user_id: int) -> bool:
-    return users.find_one({"_id": user_id}) is not None
+    try:
+        get_user(user_id)
+        return True
+    except KeyError:
+        return False
 
 
 def does_user_exist_by_name(username: str) -> bool:
-    return users.find_one({"username": username}, collation=CASE_INSENSITIVE_COLLATION) is not None
+    try:
+        get_user_by_name(username)
+        return True
+    except KeyError:
+        return False
 
 
-def user_join_guild(user_id: int, guild_id: int):
-    # Check if the user and guild exist
-    if not does_user_exist(user_id):
-        raise KeyError(f"User with id {user_id} does not exist")
-    if not does_guild_exist(guild_id):
-        raise KeyError(f"Guild with id {guild_id} does not exist")
+def user_join_guild(user_id: int, guild_id: int, trusted: bool = False) -> bool:
+    """
+    Add the user to the guild.
+    Returns False if the user was already in the guild.
 
-    # Check if the user is already in the guild
-    if users.find_one({"_id": user_id, "joined_guilds": guild_id}) is not None:
-        return
+    trusted skips checking that the user and guild exist (e.g. the user of a session
+    and a guild that was just read).
+    """
+    if not trusted:
+        if not does_user_exist(user_id):
+            raise KeyError(f"User with id {user_id} does not exist")
+        if not does_guild_exist(guild_id):
+            raise KeyError(f"Guild with id {guild_id} does not exist")
 
-    guilds.update_one({"_id": guild_id}, {"$push": {"users": user_id}})
-    users.update_one({"_id": user_id}, {"$push": {"joined_guilds": guild_id}})
+    # The unique (guild_id, user_id) index makes this atomic
+    try:
+        memberships.insert_one({"guild_id": guild_id, "user_id": user_id})
+    except DuplicateKeyError:
+        return False
+    return True
 
 
 def is_user_in_guild(user_id: int, guild_id: int) -> bool:
-    return guilds.find_one({"_id": guild_id, "users": user_id}) is not None
+    return memberships.find_one({"guild_id": guild_id, "user_id": user_id}, {"_id": 1}) is not None
+
+
+def migrate_memberships():
+    """
+    Move the members of every guild from the old guilds.users/users.joined_guilds arrays
+    to the memberships collection (safe to run more than once).
+    """
+    # The unique index skips the memberships that are in both arrays (or already migrated)
+    create_indexes(collections=["memberships"])
+    for guild in guilds.find({"users": {"$exists": True}}, {"users": 1}):
+        _insert_memberships([(guild["_id"], user_id) for user_id in guild["users"]])
+    for user in users.find({"joined_guilds": {"$exists": True}}, {"joined_guilds": 1}):
+        _insert_memberships([(guild_id, user["_id"]) for guild_id in user["joined_guilds"]])
+
+    guilds.update_many({"users": {"$exists": True}}, {"$unset": {"users": ""}})
+    users.update_many({"joined_guilds": {"$exists": True}}, {"$unset": {"joined_guilds": ""}})
+    logger.success(f"Migrated memberships ({memberships.count_documents({})} in total)")
+
+
+def _insert_memberships(pairs: list[tuple[int, int]]):
+    if not pairs:
+        return
+    try:
+        memberships.insert_many([{"guild_id": guild_id, "user_id": user_id} for guild_id, user_id in pairs],
+                                ordered=False)
+    except BulkWriteError as e:
+        # Memberships that already exist are skipped
+        if any(error["code"] != 11000 for error in e.details.get("writeErrors", [])):
+            raise
 
 
 def get_password_hash(user_id: int) -> str:
@@ -171,67 +420,245 @@ def get_password_hash(user_id: int) -> str:
     return result["password_hash"]
 
 
-def _map_db_message(m: dict):
+def get_token_generation(user_id: int) -> int:
     """
-    Converts a message from the database to a Message object
-    by replacing the author_id and attachment_id with the corresponding objects
+    Returns the session token generation of the user (tokens of older generations are revoked).
+    """
+    result = passwords.find_one({"_id": user_id}, {"token_generation": 1})
+    if result is None:
+        raise KeyError(f"User with id {user_id} does not exist")
+    return result.get("token_generation", 0)
+
+
+def increment_token_generation(user_id: int) -> int:
+    """
+    Revoke all the session tokens of the user, and return the new generation.
+    """
+    result = passwords.find_one_and_update({"_id": user_id}, {"$inc": {"token_generation": 1}},
+                                           {"token_generation": 1}, return_document=ReturnDocument.AFTER)
+    if result is None:
+        raise KeyError(f"User with id {user_id} does not exist")
+    return result["token_generation"]
+
+
+def get_users(user_ids: Iterable[int]) -> dict[int, User]:
     """
-    author = get_user(m["author_id"])
-    m["author"] = author
-    del m["author_id"]
+    Returns the users with the given ids (by id), using the cache and
+    a single query for the users that are not cached.
+    Missing users are not included.
+    """
+    result = {}
+    uncached = []
+    for user_id in user_ids:
+        user = users_by_id.get(user_id)
+        if user is None:
+            uncached.append(user_id)
+        else:
+            result[user_id] = user
+
+    if uncached:
+        for d in users.find({"_id": {"$in": uncached}}, USER_PROJECTION):
+            user = User.from_db_dict(d)
+            _cache_user(user)
+            result[user.id] = user
+    return result
+
+
+def _attachment_from_db_dict(d: dict) -> Attachment:
+    """
+    Converts a GridFS file document (of the attachments bucket) to an Attachment object
+    """
+    return Attachment(d["_id"], d["filename"], AttachmentType(d["attachment_type"]), d["width"], d["height"],
+                      d["length"])
+
+
+def get_attachments(attachment_ids: Iterable[int]) -> dict[int, Attachment]:
+    """
+    Returns the attachments with the given ids (by id), using the cache and
+    a single query for the attachments that are not cached.
+    Missing attachments are not included.
+    """
+    result = {}
+    uncached = []
+    for attachment_id in attachment_ids:
+        a = attachments_by_id.get(attachment_id)
+        if a is not None:
+            result[attachment_id] = a
+        elif not missing_attachments.get(attachment_id):
+            uncached.append(attachment_id)
+
+    if uncached:
+        for d in attachments_files.find({"_id": {"$in": uncached}}, ATTACHMENT_PROJECTION | {"hash": 1}):
+            a = _attachment_from_db_dict(d)
+            cache_attachment(a, d.get("hash"))
+            result[a.id] = a
+        for attachment_id in uncached:
+            if attachment_id not in result:
+                missing_attachments.put(attachment_id, True)
+    return result
+
 
-    if m["attachment_id"] is not None:
-        attachment = get_attachment(m["attachment_id"])
-        m["attachment"] = attachment
+def _map_db_message(m: dict, authors: dict[int, User], attachments_by_id: dict[int, Attachment]) -> Message:
+    """
+    Converts a message from the database to a Message object
+    by replacing the author_id and attachment_id with the corresponding (prefetched) objects
+    """
+    author_id = m.pop("author_id")
+    if author_id not in authors:
+        raise KeyError(f"User with id {author_id} does not exist")
+    m["author"] = authors[author_id]
+
+    attachment_id = m.pop("attachment_id")
+    if attachment_id is not None:
+        if attachment_id not in attachments_by_id:
+            raise KeyError(f"Attachment with id {attachment_id} does not exist")
+        m["attachment"] = attachments_by_id[attachment_id]
     else:
         m["attachment"] = None
-    del m["attachment_id"]
 
     return Message.from_db_dict(m)
 
 
+def _hydrate_messages(docs: list[dict]) -> list[Message]:
+    """
+    Converts a page of messages from the database to Message objects,
+    fetching all of their authors and attachments with one query each
+    """
+    authors = get_users({m["author_id"] for m in docs})
+    attachment_ids = {m["attachment_id"] for m in docs if m["attachment_id"] is not None}
+    attachments_by_id = get_attachments(attachment_ids) if attachment_ids else {}
+    return [_map_db_message(m, authors, attachments_by_id) for m in docs]
+
+
 def get_messages(channel_id: int, from_id: int, count: int) -> list[Message]:
     """
     Returns messages from the given channel before the given id
     """
     if from_id != 0:
-        return [_map_db_message(m) for m in
-                messages.find({"channel_id": channel_id, "_id": {"$lt": from_id}}).limit(count).sort("_id",-1).max_await_time_ms(1000)]
-    return [_map_db_message(m) for m in
-            messages.find({"channel_id": channel_id}).limit(count).sort("_id", -1).max_await_time_ms(1000)]
+        return _hydrate_messages(list(
+            messages.find({"channel_id": channel_id, "_id": {"$lt": from_id}}).limit(count).sort("_id", -1).max_await_time_ms(1000)))
+    return _hydrate_messages(list(
+        messages.find({"channel_id": channel_id}).limit(count).sort("_id", -1).max_await_time_ms(1000)))
+
+
+def get_messages_after_seq(channel_id: int, after_seq: int, count: int,
+                           before_seq: int | None = None) -> list[Message]:
+    """
+    Returns up to `count` messages from the given channel with a sequence number after `after_seq`
+    (and before `before_seq`, if given), oldest first
+    """
+    seq_range = {"$gt": max(after_seq, 0)}
+    if before_seq is not None:
+        seq_range["$lt"] = before_seq
+    return _hydrate_messages(list(
+        messages.find({"channel_id": channel_id, "seq": seq_range}).limit(count).sort("seq", 1).max_await_time_ms(1000)))
+
+
+def next_message_seq(channel_id: int) -> int | None:
+    """
+    Atomically reserve the next sequence number of a channel.
+    Returns None if the channel does not exist.
+    """
+    channel = channels.find_one_and_update({"_id": channel_id}, {"$inc": {"last_seq": 1}},
+                                           projection={"last_seq": 1}, return_document=ReturnDocument.AFTER)
+    return channel["last_seq"] if channel is not None else None
+
+
+def get_message_seq(channel_id: int, message_id: int) -> int:
+    """
+    Returns the sequence number of a message (0 if the message doesn't exist or has none).
+    """
+    m = messages.find_one({"_id": message_id, "channel_id": channel_id}, {"seq": 1})
+    return m.get("seq", 0) if m is not None else 0
+
+
+def backfill_message_seqs():
+    """
+    Assign sequence numbers to messages that were stored before they were introduced.
+    Should run while the server is stopped.
+    """
+    for channel in channels.find({}, {"last_seq": 1}):
+        seq = channel.get("last_seq", 0)
+        updates = []
+        for m in messages.find({"channel_id": channel["_id"], "seq": {"$exists": False}}, {"_id": 1}).sort("_id", 1):
+            seq += 1
+            updates.append(pymongo.UpdateOne({"_id": m["_id"]}, {"$set": {"seq": seq}}))
+        if updates:
+            messages.bulk_write(updates, ordered=False)
+            channels.update_one({"_id": channel["_id"]}, {"$set": {"last_seq": seq}})
+            logger.info(f"Assigned sequence numbers to {len(updates)} messages in channel {channel['_id']}")
 
 
 def get_attachment_file(attachment_id: int) -> bytes:
-    if not attachments.exists(attachment_id):
-        raise KeyError(f"Attachment with id {attachment_id} does not exist")
+    return _get_attachment_raw(attachment_id).read()
 
-    return attachments.get(attachment_id).read()
+
+def get_attachment_range(attachment_id: int, offset: int, length: int) -> tuple[bytes, int]:
+    """
+    Returns up to `length` bytes of the attachment file, starting at `offset`,
+    and the total size of the file.
+    Only the GridFS chunks that overlap the range are read.
+    """
+    attachment = _get_attachment_raw(attachment_id)
+    attachment.seek(offset)
+    return attachment.read(length), attachment.length
 
 
 def _get_attachment_raw(attachment_id: int) -> gridfs.GridOut:
-    if not attachments.exists(attachment_id):
+    if missing_attachments.get(attachment_id):
         raise KeyError(f"Attachment with id {attachment_id} does not exist")
+    try:
+        return attachments.get(attachment_id)
+    except gridfs.NoFile as e:
+        missing_attachments.put(attachment_id, True)
+        raise KeyError(f"Attachment with id {attachment_id} does not exist") from e
 
-    return attachments.get(attachment_id)
+
+def cache_attachment(a: Attachment, hash: str | None = None):
+    """
+    Add a (new) attachment to the cache.
+    """
+    attachments_by_id.put(a.id, a)
+    missing_attachments.invalidate(a.id)
+    if hash is not None:
+        attachment_ids_by_hash.put(hash, a.id)
 
 
 def does_attachment_exist(attachment_id: int) -> bool:
-    return attachments.exists(attachment_id)
+    try:
+        get_attachment(attachment_id)
+        return True
+    except KeyError:
+        return False
 
 
 def get_attachment(attachment_id: int) -> Attachment:
-    attachment = _get_attachment_raw(attachment_id)
-    filename = attachment.filename
-    attachment_type: str = attachment.attachment_type
-    width: int = attachment.width
-    height: int = attachment.height
-    size = attachment.length
-    return Attachment(attachment_id, filename, AttachmentType(attachment_type), width, height, size)
+    a = attachments_by_id.get(attachment_id)
+    if a is not None:
+        return a
+    if missing_attachments.get(attachment_id):
+        raise KeyError(f"Attachment with id {attachment_id} does not exist")
+
+    d = attachments_files.find_one({"_id": attachment_id}, ATTACHMENT_PROJECTION | {"hash": 1})
+    if d is None:
+        missing_attachments.put(attachment_id, True)
+        raise KeyError(f"Attachment with id {attachment_id} does not exist")
+    a = _attachment_from_db_dict(d)
+    cache_attachment(a, d.get("hash"))
+    return a
 
 
 def find_attachment_by_hash(hash: str) -> Attachment | None:
-    attachment = attachments.find_one({"hash": hash})
-    if attachment is None:
+    attachment_id = attachment_ids_by_hash.get(hash)
+    if attachment_id is not None:
+        try:
+            return get_attachment(attachment_id)
+        except KeyError:
+            attachment_ids_by_hash.invalidate(hash)
+
+    d = attachments_files.find_one({"hash": hash}, ATTACHMENT_PROJECTION)
+    if d is None:
         return None
-    id = attachment._id
-    return get_attachment(id)
+    a = _attachment_from_db_dict(d)
+    cache_attachment(a, hash)
+    return a
@@ -0,0 +1,161 @@
+"""
+Performs the TLS handshakes of newly accepted connections, so a slow (or malicious)
+client that stalls mid-handshake never blocks the accept loop.
+
+At most HANDSHAKE_WORKERS handshakes run at the same time, and up to MAX_PENDING_HANDSHAKES
+accepted connections wait for a worker; connections over that limit are closed right away.
+Each handshake must finish within HANDSHAKE_TIMEOUT seconds of the connection being accepted
+(the whole handshake, not each read), otherwise the connection is closed.
+
+Functions:
+- submit: Queues the handshake of an accepted socket
+- record_accept: Counts an accepted connection (for the accept rate)
+- stats: Returns the accept and handshake counters
+"""
+import os
+import selectors
+import socket
+import ssl
+import threading
+import time
+from collections import deque
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+HANDSHAKE_WORKERS = int(os.getenv("LYTECORD_HANDSHAKE_WORKERS", "16"))
+MAX_PENDING_HANDSHAKES = int(os.getenv("LYTECORD_MAX_PENDING_HANDSHAKES", "256"))
+HANDSHAKE_TIMEOUT = float(os.getenv("LYTECORD_HANDSHAKE_TIMEOUT", "10"))
+# The accept rate is measured over (at most) the last ACCEPT_RATE_WINDOW seconds
+ACCEPT_RATE_WINDOW = 60
+
+lock = threading.Lock()
+executor = ThreadPoolExecutor(max_workers=HANDSHAKE_WORKERS, thread_name_prefix="Handshake worker")
+# Accepted connections that are waiting for (or in) a handshake
+pending = threading.BoundedSemaphore(MAX_PENDING_HANDSHAKES)
+# Monotonic times of the recent accepts
+accept_times: deque[float] = deque()
+counters = {"accepted": 0, "handshakes": 0, "resumed": 0, "failed": 0, "timed_out": 0, "rejected": 0,
+            "total_handshake_ms": 0.0, "last_handshake_ms": 0.0, "max_handshake_ms": 0.0}
+
+
+def record_accept():
+    now = time.monotonic()
+    with lock:
+        counters["accepted"] += 1
+        accept_times.append(now)
+        _prune_accept_times(now)
+
+
+def _prune_accept_times(now: float):
+    """
+    Should be called with the lock acquired.
+    """
+    while accept_times and accept_times[0] < now - ACCEPT_RATE_WINDOW:
+        accept_times.popleft()
+
+
+def submit(sock: socket.socket, context: ssl.SSLContext, on_connected: Callable[[ssl.SSLSocket], None]):
+    """
+    Queue the TLS handshake of an accepted socket.
+    on_connected is called (by a handshake worker) with the TLS socket once the handshake succeeded.
+    """
+    record_accept()
+    if not pending.acquire(blocking=False):
+        with lock:
+            counters["rejected"] += 1
+        logger.warning(f"Too many pending handshakes, closing connection from {_peer(sock)}")
+        sock.close()
+        return
+
+    deadline = time.monotonic() + HANDSHAKE_TIMEOUT
+    executor.submit(_handshake, sock, context, on_connected, deadline)
+
+
+def _handshake(sock: socket.socket, context: ssl.SSLContext,
+               on_connected: Callable[[ssl.SSLSocket], None], deadline: float):
+    peer = _peer(sock)
+    start = time.perf_counter()
+    try:
+        client_sock = _do_handshake(sock, context, deadline)
+    except TimeoutError:
+        with lock:
+            counters["timed_out"] += 1
+        logger.warning(f"TLS handshake with {peer} timed out")
+        return
+    except (OSError, ValueError) as e:
+        with lock:
+            counters["failed"] += 1
+        logger.debug(f"TLS handshake with {peer} failed: {e}")
+        sock.close()
+        return
+    finally:
+        pending.release()
+
+    elapsed_ms = (time.perf_counter() - start) * 1000
+    with lock:
+        counters["handshakes"] += 1
+        counters["resumed"] += client_sock.session_reused
+        counters["total_handshake_ms"] += elapsed_ms
+        counters["last_handshake_ms"] = elapsed_ms
+        counters["max_handshake_ms"] = max(counters["max_handshake_ms"], elapsed_ms)
+
+    try:
+        on_connected(client_sock)
+    # pylint: disable=broad-except
+    except Exception as e:
+        logger.exception(f"Error starting client: {e}")
+        client_sock.close()
+
+
+def _do_handshake(sock: socket.socket, context: ssl.SSLContext, deadline: float) -> ssl.SSLSocket:
+    """
+    Perform the handshake without blocking past the deadline.
+    Raises TimeoutError if the deadline passed, or an OSError (SSLError) if the handshake failed.
+    """
+    sock.setblocking(False)
+    client_sock = context.wrap_socket(sock, server_side=True, do_handshake_on_connect=False)
+    # Not select.select, which fails for file descriptors >= 1024 (i.e. with many clients connected)
+    selector = selectors.DefaultSelector()
+    try:
+        selector.register(client_sock, selectors.EVENT_READ)
+        while True:
+            try:
+                client_sock.do_handshake()
+                break
+            except ssl.SSLWantReadError:
+                selector.modify(client_sock, selectors.EVENT_READ)
+            except ssl.SSLWantWriteError:
+                selector.modify(client_sock, selectors.EVENT_WRITE)
+
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or not selector.select(remaining):
+                raise TimeoutError("TLS handshake timed out")
+    except BaseException:
+        # The TLS socket owns the connection now
+        client_sock.close()
+        raise
+    finally:
+        selector.close()
+
+    client_sock.setblocking(True)
+    return client_sock
+
+
+def _peer(sock: socket.socket):
+    try:
+        return sock.getpeername()
+    except OSError:
+        return "unknown"
+
+
+def stats() -> dict:
+    now = time.monotonic()
+    with lock:
+        _prune_accept_times(now)
+        handshakes = counters["handshakes"]
+        window = min(ACCEPT_RATE_WINDOW, now - accept_times[0]) if accept_times else 0
+        return {**counters,
+                "accepts_per_second": len(accept_times) / window if window > 0 else 0.0,
+                "avg_handshake_ms": counters["total_handshake_ms"] / handshakes if handshakes else 0.0}
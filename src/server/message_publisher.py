@@ -1,21 +1,48 @@
 from __future__ import annotations
 import bisect
+import os
 import threading
+import time
+from collections.abc import Iterator
 
 from loguru import logger
 
 from src.shared.channel import Channel
 from src.shared.message import Message
-from src.server import channel_subscription
+from src.shared.request import Request, RequestType
+from src.server import channel_subscription, db
 
 BUFFER_SIZE = 30
+# Number of messages read from the database at a time, when a subscriber
+# missed messages that are no longer in the buffer
+CATCH_UP_BATCH_SIZE = int(os.getenv("LYTECORD_CATCH_UP_BATCH_SIZE", "100"))
+# Seconds to wait for a missing sequence number (a message that is still being sent by
+# someone else) before delivering the messages after it anyway
+GAP_TIMEOUT = float(os.getenv("LYTECORD_GAP_TIMEOUT", "2"))
 
 class MessagePublisher:
+    """
+    Buffers the latest messages of a channel and delivers them to its subscriptions.
+
+    Messages are delivered in the order of their (per channel) sequence numbers.
+    Since the numbers are dense, a subscriber that missed messages is detected by
+    comparing its last sequence number with the oldest buffered one, and a message
+    that is still being sent (a hole in the buffer) holds back the ones after it
+    for up to GAP_TIMEOUT seconds.
+    """
     def __init__(self, channel: Channel):
         self.channel = channel
         self._lock = threading.Lock()
         self._subscriptions: list[channel_subscription.ChannelSubscription] = []
+        # Sorted by sequence number (oldest first)
         self._buffer: list[Message] = []
+        # The (frozen) subscription response of every buffered message, so it is encoded
+        # once and shared by all the subscribers
+        self._responses: dict[int, Request] = {}
+        # The highest sequence number that was broadcast
+        self._last_seq: int = 0
+        # Sequence numbers that were skipped by a broadcast, and when that happened (monotonic time)
+        self._missing: dict[int, float] = {}
 
     def add_subscription(self, sub: channel_subscription.ChannelSubscription):
         logger.debug(f"Adding subscription {sub} to channel {self.channel}")
@@ -30,37 +57,118 @@ class MessagePublisher:
         with self._lock:
             return len(self._subscriptions) == 0
 
+    def last_seq(self) -> int:
+        """
+        Returns the highest sequence number that was broadcast.
+        """
+        with self._lock:
+            return self._last_seq
+
+    def buffered_count(self) -> int:
+        with self._lock:
+            return len(self._buffer)
+
     def broadcast(self, message: Message, sender: channel_subscription.ChannelSubscription):
         """
         Broadcast a message to all subscribers.
         """
         logger.debug(f"Broadcasting message {message} to channel {self.channel}")
+        new_gap = False
         with self._lock:
-            if message in self._buffer:
+            if message.id in self._responses:
                 return
 
-            bisect.insort(self._buffer, message, key=lambda x: x.sort_key())
+            bisect.insort(self._buffer, message, key=lambda x: x.seq)
+            self._responses[message.id] = create_response(message)
             if len(self._buffer) > BUFFER_SIZE:
-                self._buffer.pop()
-            for sub in self._subscriptions:
-                if sub != sender:
-                    logger.debug(f"waking up {sub}")
-                    sub.wake_up()
+                dropped = self._buffer.pop(0)
+                del self._responses[dropped.id]
+                self._missing = {seq: t for seq, t in self._missing.items() if seq > dropped.seq}
+
+            self._missing.pop(message.seq, None)
+            if self._last_seq and message.seq > self._last_seq + 1:
+                now = time.monotonic()
+                self._missing.update((seq, now) for seq in range(self._last_seq + 1, message.seq))
+                new_gap = True
+            self._last_seq = max(self._last_seq, message.seq)
+            subscriptions = [sub for sub in self._subscriptions if sub != sender]
+
+        if new_gap:
+            # Deliver the messages after the gap even if it is never filled (e.g. the insert failed)
+            timer = threading.Timer(GAP_TIMEOUT, self._wake_up_all)
+            timer.daemon = True
+            timer.start()
+
+        # Outside the lock, since the subscriptions read the buffer
+        channel_subscription.fan_out(subscriptions)
         logger.success(f"Message {message} broadcasted to channel {self.channel}")
 
-    def get_messages(self, after: int):
+    def _wake_up_all(self):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        channel_subscription.fan_out(subscriptions)
+
+    def get_message_batches(self, after_seq: int) -> Iterator[list[Message]]:
         """
-        Return messages after the given id
+        Yield the messages after the given sequence number in batches, oldest first.
+
+        Missed messages that are no longer buffered are read from the database,
+        CATCH_UP_BATCH_SIZE at a time, and then the rest are taken from the buffer.
+        A sequence number of 0 means the subscriber has no messages, so only the buffer is used.
         """
-        with self._lock:
-            if len(self._subscriptions) == 0:
-                return []
+        # The oldest buffered sequence number the database was fully read up to (-1 if it wasn't read)
+        checked_until: int | None = -1
+        while True:
+            with self._lock:
+                oldest = self._buffer[0].seq if self._buffer else None
+                gap = after_seq > 0 and (oldest is None or after_seq < oldest - 1) and oldest != checked_until
+                if not gap:
+                    messages = self._get_buffered(after_seq)
+
+            if not gap:
+                if messages:
+                    yield messages
+                return
+
+            batch = db.get_messages_after_seq(self.channel.id, after_seq, CATCH_UP_BATCH_SIZE, oldest)
+            if batch:
+                yield batch
+                after_seq = batch[-1].seq
+            if len(batch) < CATCH_UP_BATCH_SIZE:
+                # Sequence numbers that are still missing were never stored
+                checked_until = oldest
 
-            if len(self._buffer) == 0:
-                return []
+    def _get_buffered(self, after_seq: int) -> list[Message]:
+        """
+        Return the buffered messages after the given sequence number, oldest first,
+        up to the first hole that is still expected to be filled.
+        Should be called with the lock acquired.
+        """
+        index = bisect.bisect_right(self._buffer, after_seq, key=lambda x: x.seq)
+        now = time.monotonic()
+        expected = after_seq + 1
+        result = []
+        for message in self._buffer[index:]:
+            if message.seq != expected and any(expected <= seq < message.seq and now - t < GAP_TIMEOUT
+                                               for seq, t in self._missing.items()):
+                break
+            result.append(message)
+            expected = message.seq + 1
+        return result
+
+    def get_response(self, message: Message) -> Request:
+        """
+        Return the shared subscription response for the given message.
+        """
+        with self._lock:
+            response = self._responses.get(message.id)
+        if response is None:
+            response = create_response(message)
+        return response
 
-            if self._buffer[0].id < after:
-                return []
 
-            index = bisect.bisect_left(self._buffer, -after, key=lambda x: x.sort_key())
-            return self._buffer[:index]
\ No newline at end of file
+def create_response(message: Message) -> Request:
+    """
+    Create the (frozen) subscription response for a message.
+    """
+    return Request(RequestType.CHANNEL_SUBSCRIPTION, {"message": message}).freeze()
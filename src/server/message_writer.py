@@ -0,0 +1,176 @@
+"""
+Stores new messages, optionally batching the inserts of concurrent senders (write-behind).
+
+Modes (LYTECORD_MESSAGE_WRITE_MODE):
+- strict: Every message is inserted on its own before it is acknowledged (default)
+- group: Messages are queued and inserted in batches (insert_many), and each sender
+  waits until the batch with its message was written (acknowledged after the Mongo write)
+- async: Messages are acknowledged as soon as they are queued (in memory), and are
+  written in batches in the background. Faster, but queued messages are lost if the
+  server crashes (or their batch fails to be written) after they were already delivered,
+  and they may be missing from database reads for a few milliseconds (the page cache
+  isn't filled from the database while a channel has unwritten messages, see has_unwritten).
+  Since this can lose acknowledged messages, it also requires LYTECORD_UNSAFE_MESSAGE_WRITES=1
+
+A batch is written once it has MESSAGE_BATCH_SIZE messages or its first message
+waited MESSAGE_BATCH_DELAY seconds.
+
+Functions:
+- write: Stores a message document (according to the mode)
+- flush: Waits until every queued message was written
+- has_unwritten: Returns whether a channel has messages that were acknowledged but not written yet
+- stats: Returns the queue depth and batch latency counters
+"""
+import atexit
+import os
+import threading
+import time
+from concurrent.futures import Future
+from queue import Empty, Queue
+
+from loguru import logger
+from pymongo.errors import BulkWriteError, PyMongoError
+
+from src.server import db
+
+WRITE_MODES = ("strict", "group", "async")
+WRITE_MODE = os.getenv("LYTECORD_MESSAGE_WRITE_MODE", "strict")
+MESSAGE_BATCH_SIZE = int(os.getenv("LYTECORD_MESSAGE_BATCH_SIZE", "100"))
+MESSAGE_BATCH_DELAY = float(os.getenv("LYTECORD_MESSAGE_BATCH_DELAY", "0.005"))
+# Senders block once this many messages are waiting to be written
+MAX_QUEUED_MESSAGES = int(os.getenv("LYTECORD_MAX_QUEUED_MESSAGES", "10000"))
+
+if WRITE_MODE not in WRITE_MODES:
+    raise ValueError(f"Invalid message write mode {WRITE_MODE} (use one of {WRITE_MODES})")
+if WRITE_MODE == "async" and os.getenv("LYTECORD_UNSAFE_MESSAGE_WRITES", "0") != "1":
+    raise ValueError("The async message write mode can lose acknowledged messages, "
+                     "set LYTECORD_UNSAFE_MESSAGE_WRITES=1 to use it anyway")
+
+lock = threading.Lock()
+queue: Queue[tuple[dict, Future | None]] = Queue(MAX_QUEUED_MESSAGES)
+writer_thread: threading.Thread | None = None
+# Number of acknowledged but not yet written messages of each channel (async mode)
+unwritten: dict[int, int] = {}
+counters = {"batches": 0, "messages": 0, "failed": 0, "total_batch_ms": 0.0, "last_batch_ms": 0.0,
+            "max_batch_ms": 0.0, "max_batch_size": 0}
+
+
+def write(d: dict):
+    """
+    Store a message document.
+    Raises an exception (usually a PyMongoError) if the message couldn't be stored (strict and group modes).
+    """
+    if WRITE_MODE == "strict":
+        db.messages.insert_one(d)
+        return
+
+    _ensure_writer()
+    if WRITE_MODE == "async":
+        with lock:
+            unwritten[d["channel_id"]] = unwritten.get(d["channel_id"], 0) + 1
+        queue.put((d, None))
+        return
+
+    future: Future = Future()
+    queue.put((d, future))
+    future.result()
+
+
+def _ensure_writer():
+    global writer_thread
+    with lock:
+        if writer_thread is None:
+            writer_thread = threading.Thread(target=_writer, daemon=True, name="Message writer thread")
+            writer_thread.start()
+            atexit.register(flush)
+
+
+def _writer():
+    while True:
+        batch = [queue.get()]
+        deadline = time.monotonic() + MESSAGE_BATCH_DELAY
+        while len(batch) < MESSAGE_BATCH_SIZE:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(queue.get(timeout=timeout))
+            except Empty:
+                break
+
+        try:
+            _write_batch(batch)
+        # pylint: disable=broad-except
+        except Exception as e:
+            # Keeps the (only) writer thread alive, and never leaves a sender waiting
+            logger.exception(f"Failed to write a batch of {len(batch)} messages: {e}")
+            for _, future in batch:
+                if future is not None and not future.done():
+                    future.set_exception(e)
+        finally:
+            with lock:
+                for d, future in batch:
+                    if future is None:
+                        unwritten[d["channel_id"]] -= 1
+                        if unwritten[d["channel_id"]] == 0:
+                            del unwritten[d["channel_id"]]
+            for _ in batch:
+                queue.task_done()
+
+
+def _write_batch(batch: list[tuple[dict, Future | None]]):
+    start = time.perf_counter()
+    errors: dict[int, Exception] = {}
+    try:
+        db.messages.insert_many([d for d, _ in batch], ordered=False)
+    except BulkWriteError as e:
+        for error in e.details.get("writeErrors", []):
+            errors[error["index"]] = PyMongoError(error.get("errmsg", "Failed to insert message"))
+    # pylint: disable=broad-except
+    except Exception as e:
+        # e.g. a PyMongoError, or an InvalidDocument
+        errors = dict.fromkeys(range(len(batch)), e)
+    elapsed_ms = (time.perf_counter() - start) * 1000
+
+    with lock:
+        counters["batches"] += 1
+        counters["messages"] += len(batch) - len(errors)
+        counters["failed"] += len(errors)
+        counters["total_batch_ms"] += elapsed_ms
+        counters["last_batch_ms"] = elapsed_ms
+        counters["max_batch_ms"] = max(counters["max_batch_ms"], elapsed_ms)
+        counters["max_batch_size"] = max(counters["max_batch_size"], len(batch))
+
+    for i, (d, future) in enumerate(batch):
+        error = errors.get(i)
+        if future is not None:
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+        elif error is not None:
+            logger.error(f"Failed to store message {d['_id']}: {error}")
+
+
+def flush():
+    """
+    Wait until every queued message was written.
+    """
+    if writer_thread is not None:
+        queue.join()
+
+
+def has_unwritten(channel_id: int) -> bool:
+    """
+    Returns whether the channel has messages that were acknowledged but not written yet (async mode),
+    which database reads would miss.
+    """
+    with lock:
+        return channel_id in unwritten
+
+
+def stats() -> dict:
+    with lock:
+        batches = counters["batches"]
+        return {"mode": WRITE_MODE, "queue_depth": queue.qsize(), **counters,
+                "avg_batch_ms": counters["total_batch_ms"] / batches if batches else 0.0}
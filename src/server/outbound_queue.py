@@ -0,0 +1,175 @@
+"""
+A bounded queue of the frames waiting to be sent to a client, so a slow consumer
+(e.g. a subscriber on a slow link in a busy channel) can't make the server run out of memory.
+
+Frames are encoded when they are queued, so the queue knows their exact size. Only droppable
+frames (new messages pushed to a subscription) count against the limits. Responses to requests
+are always queued, since the client only has a few requests in flight at a time.
+
+When a droppable frame doesn't fit (more than MAX_OUTBOUND_MESSAGES frames or MAX_OUTBOUND_BYTES
+bytes are queued), the SLOW_CONSUMER_POLICY (LYTECORD_SLOW_CONSUMER_POLICY) applies:
+- resync: New messages of the subscription are dropped, and a resync frame is queued after the
+  ones already queued; the client then subscribes again from the last message it got (default)
+- coalesce: Like resync, but the queued messages of the subscription are dropped as well,
+  so the memory is freed right away and the client catches up with a single fetch
+- disconnect: The client is disconnected
+
+Functions:
+- stats: Returns the overflow counters and the high-water marks of the worst consumers
+"""
+import os
+import threading
+import weakref
+from collections import deque
+from dataclasses import dataclass
+
+from src.shared import protocol
+from src.shared.protocol import RequestWrapper
+from src.shared.request import Request, RequestType
+
+SLOW_CONSUMER_POLICIES = ("resync", "coalesce", "disconnect")
+SLOW_CONSUMER_POLICY = os.getenv("LYTECORD_SLOW_CONSUMER_POLICY", "resync")
+MAX_OUTBOUND_MESSAGES = int(os.getenv("LYTECORD_MAX_OUTBOUND_MESSAGES", "1000"))
+MAX_OUTBOUND_BYTES = int(os.getenv("LYTECORD_MAX_OUTBOUND_BYTES", str(4 * 1024 * 1024)))
+# Number of consumers listed by stats()
+WORST_CONSUMERS = 5
+
+if SLOW_CONSUMER_POLICY not in SLOW_CONSUMER_POLICIES:
+    raise ValueError(f"Invalid slow consumer policy {SLOW_CONSUMER_POLICY} (use one of {SLOW_CONSUMER_POLICIES})")
+
+lock = threading.Lock()
+queues: weakref.WeakSet["OutboundQueue"] = weakref.WeakSet()
+counters = {"overflows": 0, "dropped": 0, "resyncs": 0, "disconnects": 0}
+
+
+@dataclass(slots=True)
+class Frame:
+    wrapped: RequestWrapper
+    # The encoded frame (see protocol.encode)
+    parts: list[bytes]
+    size: int
+    droppable: bool
+    resync: bool = False
+
+
+class OutboundQueue():
+    """
+    The frames waiting to be sent to a client (thread safe).
+
+    Attributes:
+    - name: The name of the client (for stats)
+    - max_depth/max_bytes: The high-water marks of the queue
+    - dropped: The number of droppable frames that were dropped
+    - overflowed: Set once the client should be disconnected (disconnect policy)
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.max_depth = 0
+        self.max_bytes = 0
+        self.dropped = 0
+        self._frames: deque[Frame] = deque()
+        self._bytes = 0
+        # Ids of the subscriptions with a queued resync frame (their new messages are dropped)
+        self._resyncing: set[int] = set()
+        self.overflowed = False
+        self._lock = threading.Lock()
+        with lock:
+            queues.add(self)
+
+    def put(self, wrapped: RequestWrapper, version: int, droppable: bool = False) -> bool:
+        """
+        Queue a frame. Returns whether it was queued: False if it was dropped because the client
+        is too slow (its subscription is resyncing, or it should be disconnected, see overflowed).
+        """
+        if droppable:
+            with self._lock:
+                # Checked before encoding, since the frame would be dropped anyway
+                if self._is_dropping(wrapped.id):
+                    self._drop(1)
+                    return False
+
+        parts = protocol.encode(wrapped, version)
+        size = sum(len(part) for part in parts)
+        with self._lock:
+            if droppable:
+                if self._is_dropping(wrapped.id):
+                    self._drop(1)
+                    return False
+                if len(self._frames) >= MAX_OUTBOUND_MESSAGES or self._bytes + size > MAX_OUTBOUND_BYTES:
+                    self._overflow(wrapped.id, version)
+                    return False
+
+            self._append(Frame(wrapped, parts, size, droppable))
+        return True
+
+    def _is_dropping(self, subscription_id: int) -> bool:
+        return self.overflowed or subscription_id in self._resyncing
+
+    def _append(self, frame: Frame):
+        self._frames.append(frame)
+        self._bytes += frame.size
+        self.max_depth = max(self.max_depth, len(self._frames))
+        self.max_bytes = max(self.max_bytes, self._bytes)
+
+    def _drop(self, count: int):
+        self.dropped += count
+        with lock:
+            counters["dropped"] += count
+
+    def _overflow(self, subscription_id: int, version: int):
+        """
+        Apply the slow consumer policy. Should be called with the lock acquired.
+        """
+        with lock:
+            counters["overflows"] += 1
+        if SLOW_CONSUMER_POLICY == "disconnect":
+            self.overflowed = True
+            with lock:
+                counters["disconnects"] += 1
+            return
+
+        dropped = 1
+        if SLOW_CONSUMER_POLICY == "coalesce":
+            kept = deque(f for f in self._frames if not (f.droppable and f.wrapped.id == subscription_id))
+            dropped += len(self._frames) - len(kept)
+            self._frames = kept
+            self._bytes = sum(f.size for f in kept)
+        self._drop(dropped)
+
+        resync = RequestWrapper(Request(RequestType.CHANNEL_SUBSCRIPTION, {"status": "resync"}),
+                                subscription_id, None, True)
+        parts = protocol.encode(resync, version)
+        self._append(Frame(resync, parts, sum(len(part) for part in parts), False, resync=True))
+        self._resyncing.add(subscription_id)
+        with lock:
+            counters["resyncs"] += 1
+
+    def get(self) -> Frame | None:
+        """
+        Returns the next frame to send, or None if the queue is empty.
+        """
+        with self._lock:
+            if not self._frames:
+                return None
+            frame = self._frames.popleft()
+            self._bytes -= frame.size
+            if frame.resync:
+                self._resyncing.discard(frame.wrapped.id)
+            return frame
+
+    def __len__(self):
+        return len(self._frames)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"name": str(self.name), "depth": len(self._frames), "bytes": self._bytes,
+                    "max_depth": self.max_depth, "max_bytes": self.max_bytes, "dropped": self.dropped}
+
+
+def stats() -> dict:
+    with lock:
+        live = list(queues)
+        totals = dict(counters)
+    worst = sorted((q.stats() for q in live), key=lambda s: s["max_bytes"], reverse=True)[:WORST_CONSUMERS]
+    return {"policy": SLOW_CONSUMER_POLICY, "queues": len(live), **totals, "worst": worst}
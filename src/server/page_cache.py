@@ -0,0 +1,138 @@
+"""
+Caches the latest messages of the most active channels, so opening a channel
+(GET_MESSAGES with before=0) and scrolling through its recent history don't query the database.
+
+Each cached channel keeps its PAGE_CACHE_SIZE latest messages, already hydrated
+and converted to json serializeable dicts (shared by every response). New messages
+are added by asset_generator.generate_message, so the cache never goes stale.
+
+Functions:
+- get_messages: Same as db.get_messages, served from the cache when possible
+- add_message: Adds a newly stored message to the cache of its channel
+- stats: Returns the cache counters
+"""
+import bisect
+import os
+import threading
+
+from src.server import db, message_writer
+from src.server.cache import LRUCache
+from src.shared.message import Message
+
+PAGE_CACHE_SIZE = int(os.getenv("LYTECORD_PAGE_CACHE_SIZE", "100"))
+PAGE_CACHE_CHANNELS = int(os.getenv("LYTECORD_PAGE_CACHE_CHANNELS", "1000"))
+
+lock = threading.Lock()
+
+
+class Fetch():
+    """
+    The reads of the latest messages of a channel from the database that are in progress.
+    Only kept while there are any, so it stays as small as the number of concurrent reads.
+
+    Attributes:
+    - readers: The number of reads in progress
+    - version: Bumped on every new message of the channel, so a page read from the database
+      while a message was being added isn't cached without it
+    """
+
+    def __init__(self):
+        self.readers = 0
+        self.version = 0
+
+
+fetches: dict[int, Fetch] = {}
+
+
+class ChannelPage():
+    """
+    The latest messages of a channel.
+
+    Attributes:
+    - messages: The messages, newest first
+    - serialized: The json serializeable dicts of the messages (same order)
+    - complete: Whether these are all the messages of the channel
+    """
+
+    def __init__(self, messages: list[Message], complete: bool):
+        self.messages = messages[:PAGE_CACHE_SIZE]
+        self.serialized = [m.to_json_serializeable() for m in self.messages]
+        self.complete = complete and len(messages) <= PAGE_CACHE_SIZE
+        self.lock = threading.Lock()
+
+    def add(self, message: Message):
+        with self.lock:
+            index = bisect.bisect_left(self.messages, message.sort_key(), key=lambda x: x.sort_key())
+            if index < len(self.messages) and self.messages[index].id == message.id:
+                return
+            self.messages.insert(index, message)
+            self.serialized.insert(index, message.to_json_serializeable())
+            if len(self.messages) > PAGE_CACHE_SIZE:
+                self.messages.pop()
+                self.serialized.pop()
+                self.complete = False
+
+    def get(self, before: int, count: int) -> list[dict] | None:
+        """
+        Returns the (serialized) messages before the given id (0 for the latest),
+        or None if the page isn't entirely cached.
+        """
+        with self.lock:
+            index = 0
+            if before != 0:
+                index = bisect.bisect_right(self.messages, -before, key=lambda x: x.sort_key())
+            if index + count > len(self.messages) and not self.complete:
+                return None
+            return self.serialized[index:index + count]
+
+
+pages: LRUCache[int, ChannelPage] = LRUCache(PAGE_CACHE_CHANNELS)
+
+
+def get_messages(channel_id: int, before: int, count: int) -> list[Message] | list[dict]:
+    """
+    Returns messages from the given channel before the given id (0 for the latest), newest first.
+
+    Cached pages are returned as json serializeable dicts, which must not be modified.
+    """
+    page = pages.get(channel_id)
+    if page is not None:
+        cached = page.get(before, count)
+        if cached is not None:
+            return cached
+
+    if before != 0:
+        return db.get_messages(channel_id, before, count)
+
+    with lock:
+        fetch = fetches.setdefault(channel_id, Fetch())
+        fetch.readers += 1
+        version = fetch.version
+    # Messages still queued by the message writer (async mode) would be missing from the page
+    cacheable = not message_writer.has_unwritten(channel_id)
+    fetch_count = max(count, PAGE_CACHE_SIZE)
+    try:
+        messages = db.get_messages(channel_id, 0, fetch_count)
+        with lock:
+            if cacheable and fetch.version == version:
+                pages.put(channel_id, ChannelPage(messages, len(messages) < fetch_count))
+    finally:
+        with lock:
+            fetch.readers -= 1
+            if fetch.readers == 0:
+                del fetches[channel_id]
+    return messages[:count]
+
+
+def add_message(message: Message):
+    with lock:
+        fetch = fetches.get(message.channel_id)
+        if fetch is not None:
+            fetch.version += 1
+    page = pages.get(message.channel_id)
+    if page is not None:
+        page.add(message)
+
+
+def stats() -> dict[str, int]:
+    return pages.stats()
@@ -0,0 +1,108 @@
+"""
+Runs the bcrypt password checks and hashes of logins/registrations in a dedicated,
+size-capped process pool, so they can't take the CPU from message delivery.
+
+Admission control:
+- At most PASSWORD_WORKERS checks run at the same time, and MAX_QUEUED_PASSWORD_CHECKS more
+  may wait for a worker; past that, new checks are rejected right away (PasswordPoolBusy)
+- A single IP address may have at most MAX_PASSWORD_CHECKS_PER_IP checks queued or running
+- The caller's thread blocks until its check is done, so when requests are handled by a shared
+  thread pool (asyncio mode), the checks in flight must be capped below its size (see limit)
+
+Functions:
+- check_password: Same as login_utils.check_password, in the pool
+- hash_password: Same as login_utils.hash_password, in the pool
+- limit: Lowers the maximum number of checks queued or running
+- stats: Returns the pool counters
+"""
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from src.shared import login_utils
+
+PASSWORD_WORKERS = int(os.getenv("LYTECORD_PASSWORD_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+MAX_QUEUED_PASSWORD_CHECKS = int(os.getenv("LYTECORD_MAX_QUEUED_PASSWORD_CHECKS", "64"))
+MAX_PASSWORD_CHECKS_PER_IP = int(os.getenv("LYTECORD_MAX_PASSWORD_CHECKS_PER_IP", "4"))
+
+lock = threading.Lock()
+# Checks queued or running, past that new checks are rejected
+max_in_flight = PASSWORD_WORKERS + MAX_QUEUED_PASSWORD_CHECKS
+# Started on the first check
+executor: ProcessPoolExecutor | None = None
+# Number of checks queued or running, in total and by IP address
+in_flight = 0
+in_flight_by_ip: dict[str, int] = {}
+counters = {"checks": 0, "rejected_busy": 0, "rejected_ip": 0, "broken": 0}
+
+
+class PasswordPoolBusy(Exception):
+    pass
+
+
+def check_password(password: str, hashed: str, ip: str) -> bool:
+    """
+    Raises PasswordPoolBusy if the pool (or the IP address) has too many pending checks.
+    """
+    return _run(ip, login_utils.check_password, password, hashed)
+
+
+def hash_password(password: str, ip: str) -> str:
+    """
+    Raises PasswordPoolBusy if the pool (or the IP address) has too many pending checks.
+    """
+    return _run(ip, login_utils.hash_password, password)
+
+
+def limit(max_checks: int):
+    """
+    Allow at most `max_checks` checks queued or running (e.g. fewer than the threads
+    of a shared request pool, so logins can't block every request).
+    """
+    global max_in_flight
+    with lock:
+        max_in_flight = max(1, min(max_in_flight, max_checks))
+
+
+def _run(ip: str, func, *args):
+    global executor, in_flight
+    with lock:
+        if in_flight >= max_in_flight:
+            counters["rejected_busy"] += 1
+            raise PasswordPoolBusy("Too many pending password checks")
+        if in_flight_by_ip.get(ip, 0) >= MAX_PASSWORD_CHECKS_PER_IP:
+            counters["rejected_ip"] += 1
+            raise PasswordPoolBusy(f"Too many pending password checks from {ip}")
+
+        if executor is None:
+            # Not forked: the server process already has other threads (pymongo, clients...),
+            # whose locks could be copied while held and deadlock the workers
+            executor = ProcessPoolExecutor(max_workers=PASSWORD_WORKERS,
+                                           mp_context=multiprocessing.get_context("forkserver"))
+        pool = executor
+        in_flight += 1
+        in_flight_by_ip[ip] = in_flight_by_ip.get(ip, 0) + 1
+        counters["checks"] += 1
+
+    try:
+        return pool.submit(func, *args).result()
+    except BrokenProcessPool as e:
+        # A worker died, start a new pool for the next checks
+        with lock:
+            if executor is pool:
+                executor = None
+            counters["broken"] += 1
+        raise PasswordPoolBusy("The password pool is restarting") from e
+    finally:
+        with lock:
+            in_flight -= 1
+            in_flight_by_ip[ip] -= 1
+            if in_flight_by_ip[ip] == 0:
+                del in_flight_by_ip[ip]
+
+
+def stats() -> dict[str, int]:
+    with lock:
+        return {"workers": PASSWORD_WORKERS, "max_in_flight": max_in_flight, "in_flight": in_flight, "ips": len(in_flight_by_ip), **counters}
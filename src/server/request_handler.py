@@ -4,7 +4,7 @@ Handles requests from clients and returns responses
 Functions:
 - handle_request: Handles a request from a client and returns a response
 - ensure_correct_data: Decorator that catches invalid data exceptions, logs them, and returns an error response
-- authenticate: Authenticates a user based on the provided data
+- authenticate: Authenticates a user based on the provided data (password or session token)
 - get_guilds: Returns a list of guilds that the user is in
 - get_channels: Returns a list of channels in a guild
 - get_messages: Returns a list of messages in a channel
@@ -17,21 +17,23 @@ Functions:
 - refresh_join_code: Handles refreshing a join code for a guild
 - join_guild: Handles joining a guild with a join code
 - get_attachment_file: Handles getting an attachment file
+- get_attachment_range: Handles getting a range (chunk) of an attachment file
+- upload_attachment: Handles uploading an attachment file at once
+- upload_attachment_chunked: Handles chunked (resumable) attachment uploads
 """
 
-import base64
 import functools
-import zlib
 
 from loguru import logger
 from pymongo.errors import PyMongoError
 
-from src.server import asset_generator, db
-from src.server import channel_manager
+from src.server import asset_generator, authorization, db
+from src.server import channel_manager, page_cache, password_pool, session_tokens, upload_manager
 from src.server.channel_subscription import ChannelSubscription
 from src.server.client import Client
-from src.shared import Request, RequestType, User, Channel, ChannelType, Attachment, AttachmentType
+from src.shared import Request, RequestType, User, Channel, ChannelType, AttachmentType
 from src.shared import login_utils
+from src.shared.attachment import CHUNK_SIZE
 
 MAX_LOG_SIZE = 2000
 
@@ -66,8 +68,15 @@ def handle_request(req: Request, request_id: int, subbed: bool, client: Client)
             res_data = join_guild(req.data, client)
         case RequestType.GET_ATTACHMENT_FILE if not subbed:
             res_data = get_attachment_file(req.data, client)
+            # The file is sent as a raw blob after the response data
+            return Request(req_type, res_data, res_data.pop("file", None))
         case RequestType.UPLOAD_ATTACHMENT if not subbed:
-            res_data = upload_attachment(req.data, client)
+            res_data = upload_attachment(req.data, client, req.blob)
+        case RequestType.UPLOAD_ATTACHMENT_CHUNKED if not subbed:
+            res_data = upload_attachment_chunked(req.data, client, req.blob)
+        case RequestType.GET_ATTACHMENT_RANGE if not subbed:
+            res_data = get_attachment_range(req.data, client)
+            return Request(req_type, res_data, res_data.pop("file", None))
         case _:
             res_data = {"status": "error", "message": "Invalid request type"}
 
@@ -93,6 +102,34 @@ def ensure_correct_data(func):
 @ensure_correct_data
 def authenticate(data: dict, client: Client) -> dict:
     auth_type: str = data["subtype"]
+
+    if auth_type == "token":
+        # Reconnecting with a session token (no password check)
+        user_id = session_tokens.verify(data["token"])
+        if user_id is None:
+            return {"status": "error", "message": "Invalid or expired token"}
+
+        try:
+            user = db.get_user(user_id)
+        except KeyError:
+            return {"status": "error", "message": "Invalid or expired token"}
+        client.user = user
+        authorization.load_user(user.id)
+        return {"status": "success", "message": "Authenticated", "user": user, "token": data["token"]}
+
+    if auth_type == "logout":
+        # Revokes every session token of the user
+        if client.user is None:
+            return {"status": "error", "message": "Not logged in"}
+
+        session_tokens.revoke(client.user.id)
+        # A logged out connection must not keep receiving the messages of the channel
+        if client.current_channel is not None:
+            channel_manager.unsubscribe(client.current_channel)
+            client.current_channel = None
+        client.user = None
+        return {"status": "success", "message": "Logged out"}
+
     username: str = data["username"]
     password: str = data["password"]
 
@@ -104,9 +141,16 @@ def authenticate(data: dict, client: Client) -> dict:
             return {"status": "error", "message": "Invalid credentials"}
 
         psw_hash = db.get_password_hash(user.id)
-        if login_utils.check_password(password, psw_hash):
+        try:
+            valid = password_pool.check_password(password, psw_hash, client.name[0])
+        except password_pool.PasswordPoolBusy:
+            return {"status": "error", "message": "Server busy, try again later"}
+
+        if valid:
             client.user = user
-            return {"status": "success", "message": "Authenticated", "user": user}
+            authorization.load_user(user.id)
+            return {"status": "success", "message": "Authenticated", "user": user,
+                    "token": session_tokens.issue(user.id)}
 
     elif auth_type == "register":
         if not login_utils.is_valid_username(username):
@@ -122,9 +166,14 @@ def authenticate(data: dict, client: Client) -> dict:
         if not User.is_valid_hex_color(name_color):
             return {"status": "error", "message": "Bad name color, try a different one"}
 
-        user = asset_generator.generate_user(username, login_utils.hash_password(password), name_color)
+        try:
+            psw_hash = password_pool.hash_password(password, client.name[0])
+        except password_pool.PasswordPoolBusy:
+            return {"status": "error", "message": "Server busy, try again later"}
+
+        user = asset_generator.generate_user(username, psw_hash, name_color)
         client.user = user
-        return {"status": "success", "message": "Registered", "user": user}
+        return {"status": "success", "message": "Registered", "user": user, "token": session_tokens.issue(user.id)}
 
     return {"status": "error", "message": "Invalid credentials"}
 
@@ -135,7 +184,7 @@ def get_guilds(data: dict, client: Client) -> dict:
     if client.user is None:
         return {"status": "error", "message": "Not logged in"}
 
-    guilds = db.get_user_guilds(client.user.id)
+    guilds = authorization.load_user(client.user.id)
     return {"status": "success", "guilds": guilds}
 
 
@@ -156,12 +205,17 @@ def get_channels(data: dict, client: Client) -> dict:
 @ensure_correct_data
 def get_messages(data: dict, client: Client) -> dict:
     channel_id: int = data["channel_id"]
-    before: int = data["before"]
     count: int = data["count"]
 
-    logger.debug(f"Getting messages before {before} in channel {channel_id}")
-
-    messages = db.get_messages(channel_id, before, count)
+    if "after_seq" in data:
+        # Resume: the messages after the given sequence number, oldest first
+        after_seq: int = data["after_seq"]
+        logger.debug(f"Getting messages after seq {after_seq} in channel {channel_id}")
+        messages = db.get_messages_after_seq(channel_id, after_seq, count)
+    else:
+        before: int = data["before"]
+        logger.debug(f"Getting messages before {before} in channel {channel_id}")
+        messages = page_cache.get_messages(channel_id, before, count)
 
     if len(messages) == 0:
         if db.does_channel_exist(channel_id):
@@ -184,20 +238,25 @@ def channel_sub_handler(data: dict, client: Client, subscription_id: int) -> dic
             return {"status": "error", "message": "Already subscribed"}
 
         channel_id = data["id"]
-        last_message_id = data["last_message_id"]
         try:
             channel: Channel = db.get_channel(channel_id)
         except KeyError:
             return {"status": "error", "message": "Invalid channel id"}
 
+        if "last_seq" in data:
+            last_seq = data["last_seq"]
+        elif data["last_message_id"]:
+            # Older clients only send the id of their last message
+            last_seq = db.get_message_seq(channel_id, data["last_message_id"])
+        else:
+            last_seq = 0
+
         # Create a new subscription
         subscription = ChannelSubscription(client, subscription_id, channel)
         client.current_channel = subscription
         # Add the subscription to the channel manager
-        channel_manager.subscribe(subscription, last_message_id)
-
-        # For missed messages (if any)
-        subscription.wake_up()
+        # Missed messages (if any) are sent after the response, by the client handler
+        channel_manager.subscribe(subscription, last_seq)
         return {"status": "success", "message": f"Subscribed to channel {channel.name} with id: {channel.id}"}
     return {"status": "error", "message": "Invalid subtype (use Subscribed=false request to unsubscribe)"}
 
@@ -229,9 +288,14 @@ def new_message(data: dict, client: Client) -> dict:
     if attachment_dict is None:
         attachment = None
     else:
-        attachment = Attachment.from_json_serializeable(attachment_dict)
+        # The stored attachment (usually cached by its upload), rather than the client's copy of it
+        try:
+            attachment = db.get_attachment(attachment_dict["id"])
+        except KeyError:
+            return {"status": "error", "message": "Invalid attachment"}
 
-    message = asset_generator.generate_message(channel.id, content, client.user, attachment)
+    # The user and the channel come from the session, and the attachment was just looked up
+    message = asset_generator.generate_message(channel.id, content, client.user, attachment, trusted=True)
 
     if client.current_channel.send_message(message):
         return {"status": "success", "message": message}
@@ -250,6 +314,8 @@ def create_guild(data: dict, client: Client) -> dict:
     except ValueError as _:
         return {"status": "error", "message": "Could not create guild"}
 
+    authorization.set_role(client.user.id, guild.id, authorization.OWNER)
+
     return {"status": "success", "guild": guild}
 
 
@@ -261,10 +327,10 @@ def create_channel(data: dict, client: Client) -> dict:
     name = data["name"]
     guild_id = data["guild_id"]
 
-    if not db.does_guild_exist(guild_id):
-        return {"status": "error", "message": "Invalid guild id"}
-
-    if not client.user.id == db.get_guild_owner(guild_id):
+    role = authorization.get_role(client.user.id, guild_id)
+    if role != authorization.OWNER:
+        if role is None and not db.does_guild_exist(guild_id):
+            return {"status": "error", "message": "Invalid guild id"}
         return {"status": "error", "message": "You are not the owner of this guild"}
 
     try:
@@ -281,10 +347,10 @@ def get_join_code(data: dict, client: Client) -> dict:
         return {"status": "error", "message": "Not logged in"}
 
     guild_id = data["guild_id"]
-    if not db.does_guild_exist(guild_id):
-        return {"status": "error", "message": "Invalid guild id"}
-
-    if not client.user.id == db.get_guild_owner(guild_id):
+    role = authorization.get_role(client.user.id, guild_id)
+    if role != authorization.OWNER:
+        if role is None and not db.does_guild_exist(guild_id):
+            return {"status": "error", "message": "Invalid guild id"}
         return {"status": "error", "message": "You are not the owner of this guild"}
 
     return {"status": "success", "code": db.get_guild_join_code(guild_id)}
@@ -296,10 +362,10 @@ def refresh_join_code(data: dict, client: Client) -> dict:
         return {"status": "error", "message": "Not logged in"}
 
     guild_id = data["guild_id"]
-    if not db.does_guild_exist(guild_id):
-        return {"status": "error", "message": "Invalid guild id"}
-
-    if not client.user.id == db.get_guild_owner(guild_id):
+    role = authorization.get_role(client.user.id, guild_id)
+    if role != authorization.OWNER:
+        if role is None and not db.does_guild_exist(guild_id):
+            return {"status": "error", "message": "Invalid guild id"}
         return {"status": "error", "message": "You are not the owner of this guild"}
 
     return {"status": "success", "code": db.refresh_guild_join_code(guild_id)}
@@ -316,33 +382,46 @@ def join_guild(data: dict, client: Client) -> dict:
     if guild is None:
         return {"status": "error", "message": "Invalid code"}
 
-    if db.is_user_in_guild(client.user.id, guild.id):
+    # The user comes from the session and the guild was just read
+    if not db.user_join_guild(client.user.id, guild.id, trusted=True):
         return {"status": "error", "message": f"Already in requested guild ({guild.name})"}
 
-    db.user_join_guild(client.user.id, guild.id)
+    authorization.set_role(client.user.id, guild.id, authorization.MEMBER)
     return {"status": "success", "message": "Joined guild", "guild": guild}
 
 
 @ensure_correct_data
 def get_attachment_file(data: dict, client: Client) -> dict:
     attachment_id = data["attachment_id"]
-    if not db.does_attachment_exist(attachment_id):
+    try:
+        return {"status": "success", "file": db.get_attachment_file(attachment_id)}
+    except KeyError:
         return {"status": "error", "message": "Invalid attachment id"}
 
-    attachment = db.get_attachment_file(attachment_id)
 
-    compressed = zlib.compress(attachment)
-    return {"status": "success", "file": base64.b64encode(compressed).decode('ascii')}
+@ensure_correct_data
+def get_attachment_range(data: dict, client: Client) -> dict:
+    attachment_id: int = data["attachment_id"]
+    offset: int = data["offset"]
+    length: int = min(data["length"], CHUNK_SIZE)
+    if offset < 0 or length <= 0:
+        return {"status": "error", "message": "Invalid range"}
+
+    try:
+        file, size = db.get_attachment_range(attachment_id, offset, length)
+    except KeyError:
+        return {"status": "error", "message": "Invalid attachment id"}
+
+    return {"status": "success", "offset": offset, "size": size, "file": file}
 
 
 @ensure_correct_data
-def upload_attachment(data: dict, client: Client) -> dict:
+def upload_attachment(data: dict, client: Client, file: bytes | None) -> dict:
     if client.user is None:
         return {"status": "error", "message": "Not logged in"}
+    if file is None:
+        return {"status": "error", "message": "Missing attachment file"}
 
-    b64: str = data["file"]
-    compressed = base64.b64decode(b64)
-    file = zlib.decompress(compressed)
     filename: str = data["filename"]
     attachment_type: AttachmentType = AttachmentType.deserialize(data["type"])
 
@@ -352,3 +431,49 @@ def upload_attachment(data: dict, client: Client) -> dict:
         return {"status": "error", "message": f"Could not upload attachment: {e}"}
 
     return {"status": "success", "attachment": attachment}
+
+
+@ensure_correct_data
+def upload_attachment_chunked(data: dict, client: Client, chunk: bytes | None) -> dict:
+    """
+    Handles chunked uploads, using the following subtypes:
+    - begin: Start an upload (or resume one, if upload_id is provided), returns the offset to continue from
+    - chunk: Write a chunk (the blob of the request) at the given offset
+    - commit: Finish the upload and create the attachment
+    """
+    if client.user is None:
+        return {"status": "error", "message": "Not logged in"}
+
+    subtype: str = data["subtype"]
+    if subtype == "begin":
+        try:
+            upload = upload_manager.begin(client.user.id, data["filename"], AttachmentType.deserialize(data["type"]),
+                                          data["size"], data.get("upload_id"))
+        except ValueError as e:
+            return {"status": "error", "message": f"Could not upload attachment: {e}"}
+        return {"status": "success", "upload_id": upload.id, "offset": upload.offset, "chunk_size": CHUNK_SIZE}
+
+    upload_id: int = data["upload_id"]
+    try:
+        if subtype == "chunk":
+            if chunk is None:
+                return {"status": "error", "message": "Missing chunk"}
+            try:
+                written, offset = upload_manager.write_chunk(client.user.id, upload_id, data["offset"], chunk)
+            except ValueError as e:
+                return {"status": "error", "message": f"Could not upload attachment: {e}",
+                        "offset": upload_manager.get_offset(client.user.id, upload_id)}
+            if not written:
+                return {"status": "error", "message": "Unexpected offset", "offset": offset}
+            return {"status": "success", "offset": offset}
+
+        if subtype == "commit":
+            try:
+                attachment = upload_manager.commit(client.user.id, upload_id)
+            except ValueError as e:
+                return {"status": "error", "message": f"Could not upload attachment: {e}"}
+            return {"status": "success", "attachment": attachment}
+    except KeyError:
+        return {"status": "error", "message": "Invalid upload id"}
+
+    return {"status": "error", "message": "Invalid subtype"}
@@ -0,0 +1,90 @@
+"""
+Signed, expiring session tokens, so a client that reconnects can authenticate
+without its password (verifying a token is an HMAC, not a bcrypt check).
+
+A token is `<user id>.<generation>.<expiry>.<signature>`, where the signature is the
+HMAC-SHA256 of the rest with SESSION_SECRET. Incrementing the token generation of a user
+(stored with their password hash) revokes all their tokens. The generations are cached
+for TOKEN_GENERATION_CACHE_TTL seconds, so a revocation made by another server process
+may take that long to apply.
+
+Set LYTECORD_SESSION_SECRET (the same value for every server process), otherwise a random
+secret is used and tokens stop being valid when the server restarts.
+
+Functions:
+- issue: Creates a token for a user
+- verify: Returns the user id of a valid token
+- revoke: Revokes all the tokens of a user
+"""
+import base64
+import hashlib
+import hmac
+import os
+import secrets
+import time
+
+from loguru import logger
+
+from src.server import db
+from src.server.cache import LRUCache
+
+TOKEN_TTL = float(os.getenv("LYTECORD_SESSION_TOKEN_TTL", str(7 * 24 * 60 * 60)))
+TOKEN_GENERATION_CACHE_TTL = float(os.getenv("LYTECORD_TOKEN_GENERATION_CACHE_TTL", "60"))
+TOKEN_GENERATION_CACHE_SIZE = int(os.getenv("LYTECORD_TOKEN_GENERATION_CACHE_SIZE", "100000"))
+
+if os.getenv("LYTECORD_SESSION_SECRET"):
+    SESSION_SECRET = os.getenv("LYTECORD_SESSION_SECRET").encode()
+else:
+    logger.warning("LYTECORD_SESSION_SECRET is not set, session tokens will not survive a restart")
+    SESSION_SECRET = secrets.token_bytes(32)
+
+generations: LRUCache[int, int] = LRUCache(TOKEN_GENERATION_CACHE_SIZE, TOKEN_GENERATION_CACHE_TTL)
+
+
+def _sign(payload: str) -> str:
+    digest = hmac.new(SESSION_SECRET, payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b"=").decode()
+
+
+def _get_generation(user_id: int) -> int:
+    generation = generations.get(user_id)
+    if generation is None:
+        generation = db.get_token_generation(user_id)
+        generations.put(user_id, generation)
+    return generation
+
+
+def issue(user_id: int) -> str:
+    payload = f"{user_id}.{_get_generation(user_id)}.{int(time.time() + TOKEN_TTL)}"
+    return f"{payload}.{_sign(payload)}"
+
+
+def verify(token: str) -> int | None:
+    """
+    Returns the user id of the token, or None if it is invalid, expired or revoked.
+    """
+    payload, _, signature = token.rpartition(".")
+    if not hmac.compare_digest(_sign(payload).encode(), signature.encode()):
+        return None
+
+    try:
+        user_id, generation, expiry = (int(part) for part in payload.split("."))
+    except ValueError:
+        return None
+    if expiry < time.time():
+        return None
+
+    try:
+        if generation != _get_generation(user_id):
+            return None
+    except KeyError:
+        # The user was deleted
+        return None
+    return user_id
+
+
+def revoke(user_id: int):
+    """
+    Revoke all the tokens of the user (in every process, within TOKEN_GENERATION_CACHE_TTL).
+    """
+    generations.put(user_id, db.increment_token_generation(user_id))
@@ -0,0 +1,215 @@
+"""
+Handles chunked (and resumable) attachment uploads.
+
+Each chunk is streamed straight into GridFS, so only a single chunk of an
+upload is kept in memory. Uploads are tracked by id rather than by
+connection, so after a dropped connection the client can begin the same
+upload again and continue from the offset the server reports.
+
+Functions:
+- begin: Starts a new upload, or returns an existing one to resume
+- write_chunk: Writes a chunk of an upload at the given offset
+- get_offset: Returns the current offset of an upload
+- commit: Finishes an upload and returns the created attachment
+"""
+import os
+import threading
+import time
+from hashlib import md5
+
+from gridfs import GridIn
+from loguru import logger
+from pymongo.errors import DuplicateKeyError
+
+from src.server import asset_generator, db
+from src.shared import Attachment, AttachmentType, attachment
+
+# Seconds an upload can be idle before it is dropped
+UPLOAD_TTL = int(os.getenv("LYTECORD_UPLOAD_TTL", "600"))
+MAX_UPLOADS = int(os.getenv("LYTECORD_MAX_UPLOADS", "100"))
+
+lock = threading.Lock()
+uploads: dict[int, "Upload"] = {}
+
+
+class Upload():
+    """
+    An attachment upload in progress.
+
+    Attributes:
+    - id: The id of the upload (the attachment will have the same id)
+    - user_id: The user that started the upload
+    - filename/attachment_type/size: The attachment that is being uploaded
+    - offset: The number of bytes received so far
+    - last_active: When the upload was last written to (monotonic time)
+    """
+
+    def __init__(self, upload_id: int, user_id: int, filename: str, attachment_type: AttachmentType, size: int):
+        self.id = upload_id
+        self.user_id = user_id
+        self.filename = filename
+        self.attachment_type = attachment_type
+        self.size = size
+        self.offset = 0
+        # Set once the upload is complete and can't be written to anymore
+        self.finished = False
+        self.last_active = time.monotonic()
+        self.lock = threading.Lock()
+        self._hash = md5()
+        self._file: GridIn = db.attachments.new_file(_id=upload_id, filename=filename,
+                                                     attachment_type=attachment_type.value, width=0, height=0)
+
+    def write(self, offset: int, data: bytes) -> bool:
+        """
+        Write a chunk at the given offset.
+        Returns False (and writes nothing) if the offset isn't the current one.
+        """
+        with self.lock:
+            self.last_active = time.monotonic()
+            if offset != self.offset or self.finished:
+                return False
+            if self.offset + len(data) > self.size:
+                raise ValueError(f"Chunk exceeds the size of the upload ({self.offset + len(data)} > {self.size})")
+
+            self._file.write(data)
+            self._hash.update(data)
+            self.offset += len(data)
+            return True
+
+    def finish(self) -> Attachment:
+        """
+        Close the GridFS file and return the attachment.
+        If an identical attachment already exists, it is returned instead.
+        """
+        with self.lock:
+            if self.offset != self.size:
+                raise ValueError(f"Upload is incomplete ({self.offset} / {self.size} bytes)")
+            self.finished = True
+
+            hash = self._hash.hexdigest()
+            existing = db.find_attachment_by_hash(hash)
+            if existing is not None:
+                self._file.abort()
+                return existing
+
+            self._file.hash = hash
+            try:
+                self._file.close()
+            except DuplicateKeyError:
+                # An identical attachment was uploaded concurrently
+                db.attachments.delete(self.id)
+                existing = db.find_attachment_by_hash(hash)
+                if existing is None:
+                    raise
+                return existing
+
+            try:
+                width, height = asset_generator.analyze_attachment(db.attachments.get(self.id), self.attachment_type)
+            except ValueError:
+                db.attachments.delete(self.id)
+                raise
+
+            if width or height:
+                db.attachments_files.update_one({"_id": self.id}, {"$set": {"width": width, "height": height}})
+            a = Attachment(self.id, self.filename, self.attachment_type, width, height, self.size)
+            db.cache_attachment(a, hash)
+            return a
+
+    def abort(self):
+        with self.lock:
+            self._file.abort()
+
+
+def _remove_expired():
+    """
+    Abort uploads that were idle for longer than UPLOAD_TTL.
+    Should be called with the lock acquired.
+    """
+    now = time.monotonic()
+    for upload_id, upload in list(uploads.items()):
+        if now - upload.last_active > UPLOAD_TTL:
+            logger.info(f"Upload {upload_id} expired")
+            del uploads[upload_id]
+            upload.abort()
+
+
+def begin(user_id: int, filename: str, attachment_type: AttachmentType, size: int,
+          upload_id: int | None = None) -> Upload:
+    """
+    Start a new upload.
+    If `upload_id` is an upload of the same user that is still in progress, it is returned instead
+    (resume from its offset).
+
+    Raises a ValueError if the attachment is invalid, doesn't match the upload to resume,
+    or there are too many uploads in progress.
+    """
+    with lock:
+        _remove_expired()
+        if upload_id is not None:
+            upload = uploads.get(upload_id)
+            if upload is not None and upload.user_id == user_id:
+                if (upload.filename, upload.attachment_type, upload.size) != (filename, attachment_type, size):
+                    raise ValueError(f"Upload {upload_id} is for a different attachment")
+                upload.last_active = time.monotonic()
+                return upload
+
+        if size <= 0 or size > attachment.MAX_SIZE:
+            raise ValueError(f"Invalid attachment size ({size}, maximum is {attachment.MAX_SIZE})")
+        if len(filename) > 100 or len(filename) < 3:
+            raise ValueError("Name cannot be more than 100 characters long or less than 3 characters long")
+        if len(uploads) >= MAX_UPLOADS:
+            raise ValueError("Too many uploads in progress, try again later")
+
+        upload = Upload(asset_generator.get_id(), user_id, filename, attachment_type, size)
+        uploads[upload.id] = upload
+        return upload
+
+
+def _get_upload(user_id: int, upload_id: int) -> Upload:
+    with lock:
+        _remove_expired()
+        upload = uploads.get(upload_id)
+    if upload is None or upload.user_id != user_id:
+        raise KeyError(f"Upload with id {upload_id} does not exist")
+    return upload
+
+
+def write_chunk(user_id: int, upload_id: int, offset: int, data: bytes) -> tuple[bool, int]:
+    """
+    Write a chunk of an upload.
+
+    Returns whether the chunk was written, and the current offset of the upload
+    (which is where the next chunk should start).
+    Raises a KeyError if the upload doesn't exist.
+    """
+    if len(data) > attachment.CHUNK_SIZE:
+        raise ValueError(f"Chunk is too large ({len(data)} > {attachment.CHUNK_SIZE})")
+
+    upload = _get_upload(user_id, upload_id)
+    written = upload.write(offset, data)
+    return written, upload.offset
+
+
+def get_offset(user_id: int, upload_id: int) -> int:
+    """
+    Returns the current offset of an upload (where the next chunk should start).
+    Raises a KeyError if the upload doesn't exist.
+    """
+    return _get_upload(user_id, upload_id).offset
+
+
+def commit(user_id: int, upload_id: int) -> Attachment:
+    """
+    Finish an upload and return the created attachment.
+
+    Raises a KeyError if the upload doesn't exist, and a ValueError if it is incomplete or invalid.
+    """
+    upload = _get_upload(user_id, upload_id)
+    try:
+        a = upload.finish()
+    finally:
+        if upload.finished:
+            with lock:
+                uploads.pop(upload_id, None)
+    logger.success(f"Upload {upload_id} committed as attachment {a.id}")
+    return a
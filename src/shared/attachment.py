@@ -10,6 +10,8 @@ from src.shared.abs_data_class import AbsDataClass, Serializeable
 MAX_SIZE = 2 ** 24
 MAX_WIDTH = 2 ** 12
 MAX_HEIGHT = 2 ** 12
+# Maximum size of a single chunk in chunked attachment transfers
+CHUNK_SIZE = 2 ** 20
 
 
 class AttachmentType(Serializeable, Enum):
@@ -6,7 +6,8 @@ from loguru import logger
 
 FORMAT = "<WHITE>[{time:YYYY-MM-DD  HH:mm:ss.SSS}]</WHITE>  <level>---{level}---</level>  <cyan>[{name}</cyan>:<cyan>{function}</cyan>:<cyan>{line}]</cyan>\n<level>{extra[obfuscated_message]}\n{exception}</level>"
 
-PASSWORD_REGEX = r"(?P<pre>password: |password:|(?P<json>[\"']password[\"']:[\"']))(?P<pw>[^\s,]+)(?P<post>(?(json)['\"]))"
+# Also hides session tokens, which log a user in just like a password
+PASSWORD_REGEX = r"(?P<pre>(?:password|token): |(?:password|token):|(?P<json>[\"'](?:password|token)[\"']:[\"']))(?P<pw>[^\s,]+)(?P<post>(?(json)['\"]))"
 SUB = r"\g<pre>****\g<post>"
 
 
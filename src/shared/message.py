@@ -2,6 +2,7 @@ from dataclasses import dataclass
 
 from loguru import logger
 
+from src.shared import snowflake
 from src.shared.abs_data_class import TAG_LENGTH, AbsDataClass
 from src.shared.attachment import Attachment
 from src.shared.user import User
@@ -12,15 +13,18 @@ TAG_BYTE_LENGTH = TAG_LENGTH
 
 @dataclass(frozen=True)
 class Message(AbsDataClass):
-    # ID is an integer where the first 16 bits are a tag and the rest is a timestamp
+    # ID is a snowflake (see src.shared.snowflake) that starts with a millisecond timestamp
     # This allows to sort messages by id and have multiple messages with the same timestamp
-    # (This is similar to Discord's snowflake system)
+    # (Older messages have legacy ids, where the first 16 bits are a tag and the rest is a timestamp in seconds)
     channel_id: int
     content: str
     # attachment_id is 0 if there is no attachment
     attachment: Attachment | None
     author: User
     timestamp: int
+    # Position of the message in its channel (1, 2, 3...), assigned when the message is stored.
+    # 0 for messages stored before sequence numbers were introduced
+    seq: int = 0
 
     def __post_init__(self):
         super().__post_init__()
@@ -33,11 +37,13 @@ class Message(AbsDataClass):
         if self.timestamp <= 0:
             logger.error(f"Timestamp ({self.timestamp}) cannot be less than or equal to 0")
             raise ValueError("Timestamp cannot be less than or equal to 0")
-        if self.timestamp != self.id >> TAG_BYTE_LENGTH:
+        if self.seq < 0:
+            logger.error(f"Sequence number ({self.seq}) cannot be less than 0")
+            raise ValueError("Sequence number cannot be less than 0")
+        if self.timestamp != snowflake.timestamp(self.id):
             logger.error(
-                f"Timestamp ({self.timestamp}) must be equal to the upper bits of ID ({self.id}) (the first {TAG_BYTE_LENGTH} bits are the tag)")
-            raise ValueError(
-                f"Timestamp must be equal to the upper bits of ID (the first {TAG_BYTE_LENGTH} bits are the tag)")
+                f"Timestamp ({self.timestamp}) must be equal to the timestamp of ID ({self.id}, {snowflake.timestamp(self.id)})")
+            raise ValueError("Timestamp must be equal to the timestamp of ID (in seconds)")
 
     def sort_key(self):
         return -self.id
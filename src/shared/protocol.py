@@ -1,20 +1,63 @@
+"""
+Wire protocol shared by the client and the server.
+
+Version 1 frames are text: a 4 byte length prefix followed by
+"{id}\n{subscribed}\n{request type}\n{json data}".
+
+Version 2 frames are binary: a fixed header (see HEADER) followed by the
+json data of the request. A connection uses version 2 only if the client
+starts with a handshake (HANDSHAKE_MAGIC + version), otherwise the server
+falls back to version 1 so old clients keep working.
+
+If a v2 frame has the FLAG_BINARY flag, its payload is the length of the
+json data (4 bytes), the json data, and then the raw blob of the request.
+v1 has no binary payloads, so blobs are zlib compressed and base64 encoded
+into the json data (under BLOB_FALLBACK_KEY) instead.
+
+Frames (and compressed payloads once decompressed) larger than MAX_FRAME_SIZE
+are rejected with a ProtocolException, before anything is read or inflated.
+"""
+import asyncio
+import base64
 import socket
+import struct
+import zlib
 from collections.abc import Callable
 
 from loguru import logger
 
-from src.shared import Request
+from src.shared import MAX_ATTACHMENT_SIZE, Request, RequestType
 
 HOST = ("localhost", 24827)
 NUMBER_OF_LENGTH_BYTES = 4
 MAX_DATA_LOG_LENGTH = 500
 CERT = "server.crt"
 
+PROTOCOL_VERSION = 2
+# Sent by v2 clients right after connecting, followed by a version byte.
+# A v1 client starts with a length prefix instead, which can't start with these bytes
+# (it would mean a frame of more than 1 GiB)
+HANDSHAKE_MAGIC = b"LYT"
+# version, flags, request id, request type code, payload length
+HEADER = struct.Struct("!BBIHI")
+FLAG_SUBSCRIBED = 1
+FLAG_COMPRESSED = 1 << 1
+FLAG_BINARY = 1 << 2
+# Payloads at least this large are compressed (v2 only)
+COMPRESSION_THRESHOLD = 4096
+BLOB_FALLBACK_KEY = "file"
+# Enough for the largest attachment (base64 encoded in v1) and the data of its request
+MAX_FRAME_SIZE = 2 * MAX_ATTACHMENT_SIZE
+
 
 class SocketClosedException(Exception):
     pass
 
 
+class ProtocolException(Exception):
+    pass
+
+
 class RequestWrapper():
     def __init__(self, request: Request, request_id: int, callback: Callable[[Request], None] | None, subscribed: bool = False):
         self.request = request
@@ -23,39 +66,282 @@ class RequestWrapper():
         self.subscribed = subscribed
 
 
-def send(wrapped: RequestWrapper, socket: socket.socket):
+def encode(wrapped: RequestWrapper, version: int = 1) -> list[bytes]:
     """
-    Send a request to the given socket.
+    Encode a wrapped request into a frame, ready to be sent.
     
-    The request is wrapped in a RequestWrapper object.
+    Returns the parts of the frame, which should be sent one after another
+    (so a large blob isn't copied into a single buffer).
     """
+    if version >= 2:
+        return _encode_v2(wrapped)
+
     request_id = wrapped.id
     req = wrapped.request
     subbed = wrapped.subscribed
+    if req.blob is not None:
+        data = dict(req.data)
+        data[BLOB_FALLBACK_KEY] = base64.b64encode(zlib.compress(req.blob)).decode('ascii')
+        req = Request(req.request_type, data)
 
-    data = f"{request_id}\n{subbed}\n{req.serialize()}"
-    encoded = data.encode()
+    encoded = f"{request_id}\n{subbed}\n".encode() + req.cached("v1", lambda: req.serialize().encode())
     length = len(encoded).to_bytes(NUMBER_OF_LENGTH_BYTES, "big")
-    logger.info(
-        f"Sending {len(encoded)} bytes>>>>>>({socket.getpeername()})\n{data if len(data) < MAX_DATA_LOG_LENGTH else data[:MAX_DATA_LOG_LENGTH] + '...[TRUNCATED]'}")
-    socket.sendall(length + encoded)
+    return [length + encoded]
+
+
+def _encode_v2(wrapped: RequestWrapper) -> list[bytes]:
+    req = wrapped.request
+    flags = FLAG_SUBSCRIBED if wrapped.subscribed else 0
+
+    if req.blob is not None:
+        payload = req.encode_data()
+        flags |= FLAG_BINARY
+        length = NUMBER_OF_LENGTH_BYTES + len(payload) + len(req.blob)
+        header = HEADER.pack(PROTOCOL_VERSION, flags, wrapped.id, req.request_type.code, length)
+        return [header + len(payload).to_bytes(NUMBER_OF_LENGTH_BYTES, "big") + payload, req.blob]
+
+    # Only the header depends on the recipient, so the payload of a frozen request is encoded once
+    payload_flags, payload = req.cached("v2", lambda: _compress_payload(req.encode_data()))
+    header = HEADER.pack(PROTOCOL_VERSION, flags | payload_flags, wrapped.id, req.request_type.code, len(payload))
+    return [header + payload]
+
+
+def _compress_payload(payload: bytes) -> tuple[int, bytes]:
+    """
+    Returns the flags and the payload to send (compressed if it is large and compresses well).
+    """
+    if len(payload) >= COMPRESSION_THRESHOLD:
+        compressed = zlib.compress(payload)
+        if len(compressed) < len(payload):
+            return FLAG_COMPRESSED, compressed
+    return 0, payload
+
+
+def decode(data: bytes) -> tuple[Request, int, bool]:
+    """
+    Decode the body of a v1 frame (without the length prefix).
+    
+    Returns a tuple of the request, the request id, and whether the request is for a subscribed request.
+    """
+    id, subbed, req = data.decode().split("\n", maxsplit=2)
+    subbed = subbed == "True"
+    request = Request.deserialize(req)
+    if isinstance(request.data.get(BLOB_FALLBACK_KEY), str):
+        request.blob = _decompress(base64.b64decode(request.data.pop(BLOB_FALLBACK_KEY)))
+    return request, int(id), subbed
+
+
+def decode_header(header: bytes) -> tuple[int, int, int, int]:
+    """
+    Decode a v2 header.
+    
+    Returns a tuple of the flags, the request id, the request type code and the payload length.
+    """
+    version, flags, request_id, code, length = HEADER.unpack(header)
+    if version != PROTOCOL_VERSION:
+        raise ProtocolException(f"Unsupported frame version: {version}")
+    return flags, request_id, code, _check_length(length)
+
+
+def decode_payload(flags: int, request_id: int, code: int, payload: bytes,
+                   blob: bytes | None = None) -> tuple[Request, int, bool]:
+    """
+    Decode the (json) payload of a v2 frame, given its (decoded) header.
+    For binary frames, the blob is read separately and attached to the request as is.
+    """
+    if flags & FLAG_COMPRESSED:
+        payload = _decompress(payload)
+    try:
+        request_type = RequestType.from_code(code)
+    except KeyError as e:
+        raise ProtocolException(f"Unknown request type code: {code}") from e
+    request = Request.decode_data(request_type, payload)
+    request.blob = blob
+    return request, request_id, bool(flags & FLAG_SUBSCRIBED)
+
+
+def _check_length(length: int) -> int:
+    """
+    Returns the (declared) length of a frame, if it isn't too large.
+    """
+    if length > MAX_FRAME_SIZE:
+        raise ProtocolException(f"Frame too large ({length} bytes, maximum is {MAX_FRAME_SIZE})")
+    return length
+
+
+def _decompress(data: bytes) -> bytes:
+    """
+    Decompress zlib data, without inflating more than MAX_FRAME_SIZE bytes.
+    """
+    decompressor = zlib.decompressobj()
+    try:
+        decompressed = decompressor.decompress(data, MAX_FRAME_SIZE)
+    except zlib.error as e:
+        raise ProtocolException(f"Invalid compressed data: {e}") from e
+    if decompressor.unconsumed_tail:
+        raise ProtocolException(f"Decompressed data too large (maximum is {MAX_FRAME_SIZE} bytes)")
+    if not decompressor.eof:
+        raise ProtocolException("Truncated compressed data")
+    return decompressed
 
 
-def receive(socket: socket.socket) -> tuple[Request, int, bool]:
+def _split_binary_length(length: int, json_length_bytes: bytes) -> tuple[int, int]:
+    """
+    Returns the lengths of the json data and of the blob of a binary frame.
+    """
+    json_length = int.from_bytes(json_length_bytes, "big")
+    blob_length = length - NUMBER_OF_LENGTH_BYTES - json_length
+    if blob_length < 0:
+        raise ProtocolException(f"Invalid binary frame (json length {json_length} > frame length {length})")
+    return json_length, blob_length
+
+
+def _log_frame(prefix: str, data: bytes, peer):
+    text = data[:MAX_DATA_LOG_LENGTH].decode(errors="replace")
+    if len(data) > MAX_DATA_LOG_LENGTH:
+        text += '...[TRUNCATED]'
+    logger.info(f"{prefix} {len(data)} bytes ({peer})\n{text}")
+
+
+def send(wrapped: RequestWrapper, socket: socket.socket, version: int = 1, parts: list[bytes] | None = None):
+    """
+    Send a request to the given socket.
+    
+    The request is wrapped in a RequestWrapper object.
+    `parts` can be the already encoded frame (see encode).
+    """
+    if parts is None:
+        parts = encode(wrapped, version)
+    _log_frame("Sending>>>>>>", parts[0][HEADER.size if version >= 2 else NUMBER_OF_LENGTH_BYTES:],
+               socket.getpeername())
+    for part in parts:
+        socket.sendall(part)
+
+
+def receive(socket: socket.socket, version: int = 1) -> tuple[Request, int, bool]:
     """
     Receive a request from the given socket.
     
     Returns a tuple of the request, the request id, and whether the request is for a subscribed request.
     """
-    length = int.from_bytes(_recvall(socket, NUMBER_OF_LENGTH_BYTES), "big")
+    if version >= 2:
+        flags, request_id, code, length = decode_header(_recvall(socket, HEADER.size))
+        if flags & FLAG_BINARY:
+            json_length, blob_length = _split_binary_length(length, _recvall(socket, NUMBER_OF_LENGTH_BYTES))
+            payload = _recvall(socket, json_length)
+            blob = _recvall(socket, blob_length)
+        else:
+            payload = _recvall(socket, length)
+            blob = None
+        _log_frame("<<<<<<Received", payload, socket.getpeername())
+        return decode_payload(flags, request_id, code, payload, blob)
+
+    length = _check_length(int.from_bytes(_recvall(socket, NUMBER_OF_LENGTH_BYTES), "big"))
     if length == 0:
         raise SocketClosedException(f"Socket was closed: {socket}")
-    data = _recvall(socket, length).decode()
-    logger.info(
-        f"<<<<<<Received {length} bytes ({socket.getpeername()})\n{data if len(data) < MAX_DATA_LOG_LENGTH else data[:MAX_DATA_LOG_LENGTH] + '...[TRUNCATED]'}")
-    id, subbed, req = data.split("\n", maxsplit=2)
-    subbed = subbed == "True"
-    return Request.deserialize(req), int(id), subbed
+    data = _recvall(socket, length)
+    _log_frame("<<<<<<Received", data, socket.getpeername())
+    return decode(data)
+
+
+def client_handshake(socket: socket.socket, version: int = PROTOCOL_VERSION) -> int:
+    """
+    Ask the server to use the given protocol version.
+    
+    Returns the version the server agreed to.
+    """
+    socket.sendall(HANDSHAKE_MAGIC + bytes([version]))
+    reply = _recvall(socket, len(HANDSHAKE_MAGIC) + 1)
+    if reply[:len(HANDSHAKE_MAGIC)] != HANDSHAKE_MAGIC:
+        raise ProtocolException(f"Invalid handshake reply: {reply!r}")
+    return reply[-1]
+
+
+def server_handshake(socket: socket.socket) -> tuple[int, tuple[Request, int, bool] | None]:
+    """
+    Detect the protocol version of a newly connected client.
+    
+    Returns the version, and for v1 clients (which don't send a handshake)
+    the first request, which was already read from the socket.
+    """
+    start = _recvall(socket, NUMBER_OF_LENGTH_BYTES)
+    if start[:len(HANDSHAKE_MAGIC)] == HANDSHAKE_MAGIC:
+        version = min(start[-1], PROTOCOL_VERSION)
+        socket.sendall(HANDSHAKE_MAGIC + bytes([version]))
+        return version, None
+
+    length = _check_length(int.from_bytes(start, "big"))
+    if length == 0:
+        raise SocketClosedException(f"Socket was closed: {socket}")
+    data = _recvall(socket, length)
+    _log_frame("<<<<<<Received", data, socket.getpeername())
+    return 1, decode(data)
+
+
+async def send_async(wrapped: RequestWrapper, writer: asyncio.StreamWriter, version: int = 1,
+                     parts: list[bytes] | None = None):
+    """
+    Same as send, but for asyncio streams.
+    """
+    if parts is None:
+        parts = encode(wrapped, version)
+    _log_frame("Sending>>>>>>", parts[0][HEADER.size if version >= 2 else NUMBER_OF_LENGTH_BYTES:],
+               writer.get_extra_info("peername"))
+    writer.writelines(parts)
+    await writer.drain()
+
+
+async def receive_async(reader: asyncio.StreamReader, version: int = 1) -> tuple[Request, int, bool]:
+    """
+    Same as receive, but for asyncio streams.
+    
+    Raises a SocketClosedException if the stream is closed.
+    """
+    try:
+        if version >= 2:
+            flags, request_id, code, length = decode_header(await reader.readexactly(HEADER.size))
+            if flags & FLAG_BINARY:
+                json_length, blob_length = _split_binary_length(
+                    length, await reader.readexactly(NUMBER_OF_LENGTH_BYTES))
+                payload = await reader.readexactly(json_length)
+                blob = await reader.readexactly(blob_length)
+            else:
+                payload = await reader.readexactly(length)
+                blob = None
+            _log_frame("<<<<<<Received", payload, "stream")
+            return decode_payload(flags, request_id, code, payload, blob)
+
+        length = _check_length(int.from_bytes(await reader.readexactly(NUMBER_OF_LENGTH_BYTES), "big"))
+        if length == 0:
+            raise SocketClosedException("Stream was closed")
+        data = await reader.readexactly(length)
+    except (asyncio.IncompleteReadError, ConnectionError) as e:
+        raise SocketClosedException("Stream was closed") from e
+    _log_frame("<<<<<<Received", data, "stream")
+    return decode(data)
+
+
+async def server_handshake_async(reader: asyncio.StreamReader,
+                                 writer: asyncio.StreamWriter) -> tuple[int, tuple[Request, int, bool] | None]:
+    """
+    Same as server_handshake, but for asyncio streams.
+    """
+    try:
+        start = await reader.readexactly(NUMBER_OF_LENGTH_BYTES)
+        if start[:len(HANDSHAKE_MAGIC)] == HANDSHAKE_MAGIC:
+            version = min(start[-1], PROTOCOL_VERSION)
+            writer.write(HANDSHAKE_MAGIC + bytes([version]))
+            await writer.drain()
+            return version, None
+
+        length = _check_length(int.from_bytes(start, "big"))
+        if length == 0:
+            raise SocketClosedException("Stream was closed")
+        data = await reader.readexactly(length)
+    except (asyncio.IncompleteReadError, ConnectionError) as e:
+        raise SocketClosedException("Stream was closed") from e
+    _log_frame("<<<<<<Received", data, "stream")
+    return 1, decode(data)
 
 
 def _recvall(socket: socket.socket, length: int) -> bytes:
@@ -2,6 +2,8 @@ from __future__ import annotations
 
 import enum
 import json
+from collections.abc import Callable
+from typing import Any
 
 from src.shared.abs_data_class import AbsDataClass, Encoder, Serializeable
 
@@ -24,18 +26,94 @@ class RequestType(enum.Enum):
     JOIN_GUILD = "JoinGuild"
     GET_ATTACHMENT_FILE = "GetAttachmentFile"
     UPLOAD_ATTACHMENT = "UploadAttachment"
+    UPLOAD_ATTACHMENT_CHUNKED = "UploadAttachmentChunked"
+    GET_ATTACHMENT_RANGE = "GetAttachmentRange"
+
+    @property
+    def code(self) -> int:
+        """
+        The numeric code of the request type, used by the binary protocol.
+        """
+        return _REQUEST_TYPE_CODES[self]
+
+    @staticmethod
+    def from_code(code: int) -> "RequestType":
+        return _CODE_REQUEST_TYPES[code]
+
+
+# Codes are part of the wire format: never change or reuse a code
+_REQUEST_TYPE_CODES: dict[RequestType, int] = {
+    RequestType.AUTHENTICATE: 1,
+    RequestType.REGISTER: 2,
+    RequestType.UNAUTHORIZED: 3,
+    RequestType.ERROR: 4,
+    RequestType.SEND_MESSAGE: 5,
+    RequestType.CHANNEL_SUBSCRIPTION: 6,
+    RequestType.GET_GUILDS: 7,
+    RequestType.GET_CHANNELS: 8,
+    RequestType.GET_MESSAGES: 9,
+    RequestType.GET_ASSET: 10,
+    RequestType.CREATE_GUILD: 11,
+    RequestType.CREATE_CHANNEL: 12,
+    RequestType.GET_JOIN_CODE: 13,
+    RequestType.REFRESH_JOIN_CODE: 14,
+    RequestType.JOIN_GUILD: 15,
+    RequestType.GET_ATTACHMENT_FILE: 16,
+    RequestType.UPLOAD_ATTACHMENT: 17,
+    RequestType.UPLOAD_ATTACHMENT_CHUNKED: 18,
+    RequestType.GET_ATTACHMENT_RANGE: 19,
+}
+_CODE_REQUEST_TYPES: dict[int, RequestType] = {code: t for t, code in _REQUEST_TYPE_CODES.items()}
 
 
 class Request():
-    def __init__(self, request_type: RequestType, data: dict | Serializeable):
+    """
+    A request (or a response) sent between the client and the server.
+    
+    `blob` is optional raw binary data (e.g. an attachment file) that is sent
+    as is after the json data, instead of being encoded inside it.
+
+    A frozen request (see freeze) must not be modified anymore, and its
+    encodings are computed once and reused, e.g. when the same message is
+    sent to every subscriber of a channel.
+    """
+    def __init__(self, request_type: RequestType, data: dict | Serializeable, blob: bytes | None = None):
         self.request_type = request_type
         self.data: dict = data if isinstance(data, dict) else data.to_json_serializeable()
+        self.blob = blob
+        self.frozen = False
+        self._cache: dict[str, Any] = {}
+
+    def freeze(self) -> "Request":
+        self.frozen = True
+        return self
+
+    def cached(self, key: str, encoder: Callable[[], Any]) -> Any:
+        """
+        Returns encoder(), which is only called once per key if the request is frozen.
+        """
+        if not self.frozen:
+            return encoder()
+        value = self._cache.get(key)
+        if value is None:
+            value = self._cache[key] = encoder()
+        return value
 
     def __str__(self):
+        if self.blob is not None:
+            return f"Request({self.request_type}, {self.data}, <{len(self.blob)} bytes>)"
         return f"Request({self.request_type}, {self.data})"
 
-    def serialize(self):
-        return f"{str(self.request_type.value)}\n{json.dumps(self.data, cls=Encoder, separators=(',', ':'))}"
+    def serialize(self) -> str:
+        return self.cached("serialize", lambda: f"{str(self.request_type.value)}\n"
+                                                f"{json.dumps(self.data, cls=Encoder, separators=(',', ':'))}")
+
+    def encode_data(self) -> bytes:
+        """
+        Encode only the data of the request (used by the binary protocol,
+        where the request type is part of the header).
+        """
+        return self.cached("data", lambda: json.dumps(self.data, cls=Encoder, separators=(',', ':')).encode())
 
     @staticmethod
     def deserialize(string: str) -> "Request":
@@ -44,3 +122,13 @@ class Request():
         if isinstance(data, dict):
             return Request(RequestType(request_type), data)
         raise ValueError(f"Invalid data (got: {data})")
+
+    @staticmethod
+    def decode_data(request_type: RequestType, payload: bytes) -> "Request":
+        """
+        Inverse of encode_data.
+        """
+        data = json.loads(payload)
+        if isinstance(data, dict):
+            return Request(request_type, data)
+        raise ValueError(f"Invalid data (got: {data})")
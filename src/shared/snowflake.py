@@ -0,0 +1,114 @@
+"""
+Snowflake ids (similar to Discord's/Twitter's).
+
+An id is a 64 bit integer made of (from the most significant bits):
+- 41 bits: milliseconds since EPOCH_MS
+- 10 bits: the worker id (so that multiple server processes never generate the same id)
+- 12 bits: a per worker sequence number (up to 4096 ids per millisecond per worker)
+
+Ids sort by creation time. Ids created before snowflakes were introduced (legacy ids)
+are `seconds << TAG_LENGTH | tag` and are always smaller than LEGACY_ID_LIMIT, while every
+snowflake created since is larger, so old and new data keep sorting correctly together.
+
+Functions:
+- make_id: Builds an id from its parts
+- timestamp_ms/timestamp: Decode the creation time of an id (legacy or snowflake)
+- is_legacy: Whether an id uses the legacy layout
+"""
+import os
+import threading
+import time
+
+from src.shared.abs_data_class import TAG_LENGTH
+
+# 2024-01-01T00:00:00Z
+EPOCH_MS = 1704067200000
+WORKER_ID_BITS = 10
+SEQUENCE_BITS = 12
+MAX_WORKER_ID = 2 ** WORKER_ID_BITS - 1
+MAX_SEQUENCE = 2 ** SEQUENCE_BITS - 1
+TIMESTAMP_SHIFT = WORKER_ID_BITS + SEQUENCE_BITS
+# Legacy ids have a 32 bit (seconds) timestamp
+LEGACY_ID_LIMIT = 2 ** (32 + TAG_LENGTH)
+
+
+def make_id(ms: int, worker_id: int = 0, sequence: int = 0) -> int:
+    """
+    Build an id from a unix timestamp in milliseconds, a worker id and a sequence number.
+    """
+    if not 0 <= worker_id <= MAX_WORKER_ID:
+        raise ValueError(f"Worker id must be between 0 and {MAX_WORKER_ID} (got {worker_id})")
+    if not 0 <= sequence <= MAX_SEQUENCE:
+        raise ValueError(f"Sequence must be between 0 and {MAX_SEQUENCE} (got {sequence})")
+    return ((ms - EPOCH_MS) << TIMESTAMP_SHIFT) | (worker_id << SEQUENCE_BITS) | sequence
+
+
+def is_legacy(id: int) -> bool:
+    return id < LEGACY_ID_LIMIT
+
+
+def timestamp_ms(id: int) -> int:
+    """
+    Returns the unix timestamp (in milliseconds) the id was created at.
+    Legacy ids only have second precision.
+    """
+    if is_legacy(id):
+        return (id >> TAG_LENGTH) * 1000
+    return (id >> TIMESTAMP_SHIFT) + EPOCH_MS
+
+
+def timestamp(id: int) -> int:
+    """
+    Returns the unix timestamp (in seconds) the id was created at.
+    """
+    if is_legacy(id):
+        return id >> TAG_LENGTH
+    return timestamp_ms(id) // 1000
+
+
+class SnowflakeGenerator():
+    """
+    Generates unique, increasing ids for a single worker.
+
+    The lock only guards a few integer operations, and each generator (worker)
+    has its own, so generating ids doesn't contend with anything else.
+
+    Attributes:
+    - worker_id: The worker id that is part of every generated id
+    - _last_ms: The millisecond of the last generated id
+    - _sequence: The sequence number of the last generated id
+    """
+
+    def __init__(self, worker_id: int):
+        if not 0 <= worker_id <= MAX_WORKER_ID:
+            raise ValueError(f"Worker id must be between 0 and {MAX_WORKER_ID} (got {worker_id})")
+        self.worker_id = worker_id
+        self._last_ms = 0
+        self._sequence = 0
+        self._lock = threading.Lock()
+
+    def next_id(self) -> int:
+        with self._lock:
+            ms = time.time_ns() // 1_000_000
+            if ms > self._last_ms:
+                self._last_ms = ms
+                self._sequence = 0
+            else:
+                # Same millisecond, or the clock went backwards: keep counting from the last millisecond
+                # (and borrow the next one once the sequence runs out), so ids never repeat or decrease
+                self._sequence += 1
+                if self._sequence > MAX_SEQUENCE:
+                    self._last_ms += 1
+                    self._sequence = 0
+            return make_id(self._last_ms, self.worker_id, self._sequence)
+
+
+def default_worker_id() -> int:
+    """
+    The worker id of this process: LYTECORD_WORKER_ID if set, otherwise derived from the process id.
+    Processes that share a database should set distinct worker ids.
+    """
+    worker_id = os.getenv("LYTECORD_WORKER_ID")
+    if worker_id is not None:
+        return int(worker_id)
+    return os.getpid() % (MAX_WORKER_ID + 1)